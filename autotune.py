@@ -0,0 +1,222 @@
+# imports
+import os
+import json
+import time
+import argparse
+import platform
+import tempfile
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List
+
+import laspy
+import pdal
+
+from spatial_lib import run_pipe_with_time, peak_rss_mb
+import grid_rasters
+
+
+#############################################
+# auto-tune CHUNK_SIZE and the worker count from short calibration runs on a sample tile
+#############################################
+
+# Configuration section - edit these settings as needed
+class Config:
+    SETTINGS_FILE = os.path.join("output", "cache", "autotune.json")  # Persisted results
+    CHUNK_SIZES = [10_000, 50_000, 100_000, 250_000, 1_000_000]  # Streaming chunk sizes to try
+    GRID_CHUNK_SIZES = [500_000, 1_000_000, 2_000_000, 5_000_000]  # laspy chunk sizes to try for grid_rasters.py
+    SAMPLE_POINTS = 2_000_000  # Points read from the sample tile per calibration run
+    MEMORY_BUDGET_MB = None  # None: use 75% of physical memory
+
+
+def machine_key() -> str:
+    """Identify this machine - settings are only reused on the machine that measured them."""
+    return f"{platform.node()}|{platform.machine()}|{os.cpu_count()}cpu"
+
+
+def dataset_profile(sample_file: str) -> str:
+    """
+    Describe the kind of data in a file from its header: format, point format and
+    the order of magnitude of points per tile. Files with the same profile share settings.
+    """
+    ext = os.path.splitext(sample_file)[1].lower().lstrip(".")
+    if ext == "xyz":
+        return "xyz"
+    with laspy.open(sample_file) as reader:
+        header = reader.header
+        magnitude = len(str(max(header.point_count, 1))) - 1
+        return f"{ext}|pf{header.point_format.id}|1e{magnitude}pts"
+
+
+def physical_memory_mb() -> float:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 ** 2
+    except (ValueError, OSError, AttributeError):
+        # not available on Windows
+        return None
+
+
+def calibration_run(sample_file: str, chunk_size: int, streaming: bool, sample_points: int,
+                    output_file: str) -> Dict[str, Any]:
+    """
+    Read and rewrite (compressed) the first sample_points of the sample tile.
+    Executed in a fresh worker process so the peak RSS belongs to this run.
+    """
+    pipeline = {"pipeline": [
+        {"type": "readers.las", "filename": sample_file, "count": sample_points},
+        {"type": "writers.las", "filename": output_file, "compression": "laszip"},
+    ]}
+    start_time = time.time()
+    points = run_pipe_with_time(pdal.Pipeline(json.dumps(pipeline)), streaming=streaming, chunk_size=chunk_size)
+    return {"points": points, "wall_s": time.time() - start_time, "peak_rss_mb": peak_rss_mb()}
+
+
+def grid_calibration_run(sample_file: str, chunk_size: int, sample_points: int) -> Dict[str, Any]:
+    """
+    Grid the first sample_points of the sample tile into a DSM and DTM the way
+    grid_rasters.py does. Executed in a fresh worker process so the peak RSS belongs to this run.
+    """
+    grid = grid_rasters.SurfaceGrid(grid_rasters.file_bounds(sample_file), grid_rasters.Config.RESOLUTION)
+    start_time = time.time()
+    points = grid_rasters.grid_points(sample_file, [grid], chunk_size, max_points=sample_points)
+    return {"points": points, "wall_s": time.time() - start_time, "peak_rss_mb": peak_rss_mb()}
+
+
+def measure_grid(sample_file: str, chunk_size: int, sample_points: int) -> Dict[str, Any]:
+    """Run the gridding calibration on one worker and measure its throughput and memory."""
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        run = executor.submit(grid_calibration_run, sample_file, chunk_size, sample_points).result()
+    return {
+        "stage": "grid",
+        "chunk_size": chunk_size,
+        "workers": 1,
+        "points_per_s": run["points"] / run["wall_s"],
+        "memory_mb": run["peak_rss_mb"],
+    }
+
+
+def measure(sample_file: str, chunk_size: int, workers: int, streaming: bool, sample_points: int) -> Dict[str, Any]:
+    """Run the calibration on `workers` processes at once and measure the combined throughput and memory."""
+    with tempfile.TemporaryDirectory() as tmp_dir, ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(calibration_run, sample_file, chunk_size, streaming, sample_points,
+                            os.path.join(tmp_dir, f"calibration_{i}.laz"))
+            for i in range(workers)
+        ]
+        runs = [f.result() for f in futures]
+    wall_s = max(r["wall_s"] for r in runs)
+    peaks = [r["peak_rss_mb"] for r in runs]
+    return {
+        "chunk_size": chunk_size,
+        "workers": workers,
+        "points_per_s": sum(r["points"] for r in runs) / wall_s,
+        "memory_mb": sum(peaks) if None not in peaks else None,
+    }
+
+
+def within_budget(result: Dict[str, Any], budget_mb: float) -> bool:
+    return budget_mb is None or result["memory_mb"] is None or result["memory_mb"] <= budget_mb
+
+
+def autotune(sample_file: str, chunk_sizes: List[int] = None, max_workers: int = None,
+             memory_budget_mb: float = None, sample_points: int = None) -> Dict[str, Any]:
+    """
+    Pick the streaming chunk size and the number of worker processes that give the
+    most points/sec within the memory budget, then persist them for this machine
+    and the sample's dataset profile.
+
+    PDAL has no pipeline-wide thread count, so the parallelism tuned here is the
+    number of worker processes (process_laz.py --parallel). The chunk size is tuned
+    with one streaming worker; the worker count with the best chunk size and whole
+    sample in memory per worker, like the per-tile HAG pipelines.
+
+    grid_rasters.py reads with laspy and bins with numpy instead of streaming through
+    PDAL, so its chunk size is tuned on its own (GRID_CHUNK_SIZES) and persisted as
+    grid_chunk_size.
+    """
+    chunk_sizes = chunk_sizes or Config.CHUNK_SIZES
+    max_workers = max_workers or os.cpu_count() or 1
+    sample_points = sample_points or Config.SAMPLE_POINTS
+    if memory_budget_mb is None:
+        memory_budget_mb = Config.MEMORY_BUDGET_MB
+    if memory_budget_mb is None and physical_memory_mb() is not None:
+        memory_budget_mb = 0.75 * physical_memory_mb()
+
+    results = []
+    print(f"Tuning the chunk size on {sample_file}")
+    for chunk_size in chunk_sizes:
+        result = measure(sample_file, chunk_size, 1, True, sample_points)
+        print(f"  chunk size {chunk_size:>9,}: {result['points_per_s']:>12,.0f} pts/s, {result['memory_mb'] or 0:,.0f} MB")
+        results.append(result)
+    candidates = [r for r in results if within_budget(r, memory_budget_mb)] or results
+    best_chunk = max(candidates, key=lambda r: r["points_per_s"])["chunk_size"]
+
+    print(f"Tuning the worker count with chunk size {best_chunk:,}")
+    worker_counts = sorted({1, *[w for w in (2, 4, 8, 12, 16, 24, 32) if w < max_workers], max_workers})
+    best_workers = None
+    for workers in worker_counts:
+        result = measure(sample_file, best_chunk, workers, False, sample_points)
+        print(f"  {workers:>3} workers: {result['points_per_s']:>12,.0f} pts/s, {result['memory_mb'] or 0:,.0f} MB")
+        results.append(result)
+        if not within_budget(result, memory_budget_mb):
+            # more workers will only use more memory
+            break
+        if best_workers is None or result["points_per_s"] > best_workers["points_per_s"]:
+            best_workers = result
+
+    print("Tuning the gridding chunk size (grid_rasters.py)")
+    grid_results = []
+    for chunk_size in Config.GRID_CHUNK_SIZES:
+        result = measure_grid(sample_file, chunk_size, sample_points)
+        print(f"  chunk size {chunk_size:>9,}: {result['points_per_s']:>12,.0f} pts/s, {result['memory_mb'] or 0:,.0f} MB")
+        grid_results.append(result)
+    results.extend(grid_results)
+    candidates = [r for r in grid_results if within_budget(r, memory_budget_mb)] or grid_results
+    best_grid_chunk = max(candidates, key=lambda r: r["points_per_s"])["chunk_size"]
+
+    settings = {
+        "chunk_size": best_chunk,
+        "parallel": best_workers["workers"] if best_workers else 1,
+        "grid_chunk_size": best_grid_chunk,
+        "memory_budget_mb": memory_budget_mb,
+        "sample_file": sample_file,
+        "tuned_at": datetime.now().isoformat(timespec="seconds"),
+        "results": results,
+    }
+    save_settings(dataset_profile(sample_file), settings)
+    print(f"Tuned settings: CHUNK_SIZE={settings['chunk_size']:,}, PARALLEL={settings['parallel']}, "
+          f"grid CHUNK_SIZE={settings['grid_chunk_size']:,}")
+    return settings
+
+
+def save_settings(profile: str, settings: Dict[str, Any], settings_file: str = None):
+    settings_file = settings_file or Config.SETTINGS_FILE
+    stored = {}
+    if os.path.exists(settings_file):
+        with open(settings_file) as f:
+            stored = json.load(f)
+    stored.setdefault(machine_key(), {})[profile] = settings
+    os.makedirs(os.path.dirname(settings_file), exist_ok=True)
+    with open(settings_file, "w") as f:
+        json.dump(stored, f, indent=2)
+
+
+def load_settings(sample_file: str, settings_file: str = None) -> Dict[str, Any]:
+    """Get the tuned settings for this machine and the sample's dataset profile (None if not tuned)."""
+    settings_file = settings_file or Config.SETTINGS_FILE
+    if not os.path.exists(settings_file):
+        return None
+    with open(settings_file) as f:
+        stored = json.load(f)
+    return stored.get(machine_key(), {}).get(dataset_profile(sample_file))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Auto-tune CHUNK_SIZE and the worker count on a sample tile.')
+    parser.add_argument('sample', help='Sample LAS/LAZ tile, representative of the survey')
+    parser.add_argument('--budget', type=float, help='Memory budget in MB (default 75%% of physical memory)')
+    parser.add_argument('--max-workers', type=int, help='Largest worker count to try (default CPU count)')
+    parser.add_argument('--points', type=int, default=Config.SAMPLE_POINTS, help='Points per calibration run')
+
+    args = parser.parse_args()
+    autotune(args.sample, max_workers=args.max_workers, memory_budget_mb=args.budget, sample_points=args.points)
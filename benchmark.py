@@ -0,0 +1,287 @@
+# imports
+import os
+import json
+import time
+import shutil
+import argparse
+import subprocess
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List
+
+import numpy as np
+import laspy
+
+from spatial_lib import grid_cell_stem_proxy, peak_rss_mb
+
+
+#############################################
+# benchmark suite on synthetic surveys - runs offline, no real survey data needed
+#############################################
+
+# Configuration section - edit these settings as needed
+class Config:
+    # Where the synthetic surveys and outputs are written (deleted and recreated per size)
+    WORK_DIR = os.path.join("output", "benchmarks")
+    RESULTS_FILE = os.path.join("output", "benchmarks", "results.jsonl")
+
+    # Survey sizes - tiles per side, tile size in metres, points per m²
+    SIZES = {
+        "small": {"tiles": 2, "tile_size": 250, "density": 4},
+        "medium": {"tiles": 3, "tile_size": 500, "density": 8},
+        "large": {"tiles": 4, "tile_size": 1000, "density": 10},
+    }
+
+    FORMAT = "laz"  # Synthetic tile format: 'las', 'laz' or 'xyz'
+    ORIGIN = (295000, 6425000)  # Bottom left corner of the synthetic survey
+    DATE = "2000-01-01"  # Survey date folder name
+    PARALLEL = 4  # Worker processes for the parallel case
+    RESOLUTION = 0.5  # Raster resolution in metres
+    SEED = 42
+
+    # Classification values
+    GROUND_CLASS = 2
+    NON_GROUND_CLASS = 4
+
+
+CASES = ["single", "separated", "separated_tiled", "separated_parallel", "rasters", "metrics"]
+
+
+def ground_surface(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Smooth rolling terrain."""
+    return 100 + 5 * np.sin(x / 200) + 3 * np.cos(y / 150)
+
+
+def generate_tile(rng: np.random.Generator, x0: float, y0: float, tile_size: float, density: float):
+    """
+    Generate one tile of ground and vegetation points.
+    Vegetation is ~400 stems/ha with crowns around each stem.
+    Returns (ground_xyz, vegetation_xyz).
+    """
+    n_points = int(tile_size ** 2 * density)
+    n_ground = n_points // 2
+    n_veg = n_points - n_ground
+
+    gx = x0 + rng.random(n_ground) * tile_size
+    gy = y0 + rng.random(n_ground) * tile_size
+    gz = ground_surface(gx, gy) + rng.normal(0, 0.05, n_ground)
+
+    n_trees = max(1, int(tile_size ** 2 / 10_000 * 400))
+    tx = x0 + rng.random(n_trees) * tile_size
+    ty = y0 + rng.random(n_trees) * tile_size
+    th = rng.uniform(0.5, 12, n_trees)
+    tree = rng.integers(n_trees, size=n_veg)
+    radius = 0.3 * th[tree] * np.sqrt(rng.random(n_veg))
+    angle = rng.random(n_veg) * 2 * np.pi
+    vx = np.clip(tx[tree] + radius * np.cos(angle), x0, x0 + tile_size - 0.001)
+    vy = np.clip(ty[tree] + radius * np.sin(angle), y0, y0 + tile_size - 0.001)
+    vz = ground_surface(vx, vy) + th[tree] * rng.uniform(0.3, 1.0, n_veg)
+
+    return np.column_stack([gx, gy, gz]), np.column_stack([vx, vy, vz])
+
+
+def write_points(path: str, xyz: np.ndarray, classification, fmt: str):
+    """
+    Write points to LAS/LAZ (with classification and EPSG:7856) or XYZ text.
+    classification is one class for all points or an array with one per point.
+    """
+    if fmt == "xyz":
+        np.savetxt(path, xyz, fmt="%.3f")
+        return
+    import pyproj
+    header = laspy.LasHeader(point_format=6, version="1.4")
+    header.offsets = np.floor(xyz.min(axis=0))
+    header.scales = np.array([0.001, 0.001, 0.001])
+    header.add_crs(pyproj.CRS.from_epsg(7856))
+    las = laspy.LasData(header)
+    las.x, las.y, las.z = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+    las.classification = np.broadcast_to(np.asarray(classification, dtype=np.uint8), len(xyz)).copy()
+    las.write(path, do_compress=fmt == "laz")
+
+
+def generate_synthetic_survey(root: str, tiles: int, tile_size: float, density: float, fmt: str, seed: int) -> int:
+    """
+    Write a synthetic survey with the same layout as the real data:
+      <root>/input/lidar/<date>/Ground|Non-Ground   - separated mode
+      <root>/input/lidar/<date>-single             - single mode (both classes per tile)
+    Returns the total point count.
+    """
+    rng = np.random.default_rng(seed)
+    date_dir = os.path.join(root, "input", "lidar", Config.DATE)
+    ground_dir = os.path.join(date_dir, "Ground")
+    non_ground_dir = os.path.join(date_dir, "Non-Ground")
+    single_dir = date_dir + "-single"
+    for d in (ground_dir, non_ground_dir, single_dir):
+        os.makedirs(d, exist_ok=True)
+
+    total = 0
+    for i in range(tiles):
+        for j in range(tiles):
+            x0 = Config.ORIGIN[0] + i * tile_size
+            y0 = Config.ORIGIN[1] + j * tile_size
+            ground, veg = generate_tile(rng, x0, y0, tile_size, density)
+            prefix = f"{int(x0)}_{int(y0)}_SYNTH_MGA56_GDA2020"
+            write_points(os.path.join(ground_dir, f"{prefix}_gnd.{fmt}"), ground, Config.GROUND_CLASS, fmt)
+            write_points(os.path.join(non_ground_dir, f"{prefix}_non-gnd.{fmt}"), veg, Config.NON_GROUND_CLASS, fmt)
+            # single mode files carry both classes (dropped for XYZ)
+            both = np.vstack([ground, veg])
+            classes = np.concatenate([
+                np.full(len(ground), Config.GROUND_CLASS, dtype=np.uint8),
+                np.full(len(veg), Config.NON_GROUND_CLASS, dtype=np.uint8),
+            ])
+            write_points(os.path.join(single_dir, f"{prefix}.{fmt}"), both, classes, fmt)
+            total += len(both)
+    return total
+
+
+def case_process_laz(mode: str, input_dir: str, output_dir: str, tile_size: float, parallel: int,
+                     tiled_hag: bool, telemetry: str):
+    """Run process_laz.py on the synthetic survey."""
+    import process_laz
+    cfg = process_laz.Config
+    cfg.MODE = mode
+    cfg.INPUT_DIR = input_dir
+    cfg.OUTPUT_DIR = output_dir
+    cfg.SPATIAL_FILTER = None
+    cfg.TILE_SIZE = int(tile_size)
+    cfg.PARALLEL = parallel
+    cfg.TILED_HAG = tiled_hag  # set for every case - the process_laz default has changed before
+    cfg.INCREMENTAL = False
+    cfg.AUTOTUNE = False  # measure the requested settings, not the ones tuned on this machine
+    cfg.XYZ_CACHE_DIR = os.path.join(os.path.dirname(output_dir), "cache", "xyz")
+    cfg.TELEMETRY_FILE = telemetry
+    process_laz.process_files()
+
+
+def case_rasters(las_file: str, output_dir: str, bounds, resolution: float):
+    """Generate the DSM, DTM and CHM like generate_rasters.ipynb."""
+    import grid_rasters
+    grid_rasters.Config.AUTOTUNE = False  # measure the default chunk size, not the tuned one
+    grid_rasters.generate_rasters(las_file, resolution, bounds=bounds, output_dir=output_dir)
+
+
+def case_metrics(las_file: str, chm_file: str):
+    """Run the CHM summary and the stem density proxy."""
+    from metrics import chm_summary
+    chm_summary(chm_file)
+    grid_cell_stem_proxy(las_file)
+
+
+def run_case(func, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Run one case and measure it. Executed in a fresh worker process so peak RSS is per case.
+    Cases that run their own worker processes (e.g. the tile pool) also report the peak
+    of their largest worker, which the case's own peak doesn't include.
+    """
+    start_time = time.time()
+    start_cpu = time.process_time()
+    func(**kwargs)
+    return {
+        "wall_s": round(time.time() - start_time, 3),
+        "cpu_s": round(time.process_time() - start_cpu, 3),
+        "peak_rss_mb": peak_rss_mb(),
+        "worker_peak_rss_mb": peak_rss_mb(children=True),
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes: List[str], cases: List[str], fmt: str) -> List[Dict[str, Any]]:
+    """Generate each synthetic survey size and run the cases over it."""
+    results = []
+    revision = git_revision()
+    for size in sizes:
+        spec = Config.SIZES[size]
+        root = os.path.join(Config.WORK_DIR, size)
+        shutil.rmtree(root, ignore_errors=True)
+
+        print(f"Generating {size} synthetic survey: {spec}")
+        points = generate_synthetic_survey(root, spec["tiles"], spec["tile_size"], spec["density"], fmt, Config.SEED)
+
+        date_dir = os.path.join(root, "input", "lidar", Config.DATE)
+        processed_dir = os.path.join(root, "output", "processed", Config.DATE)
+        merged = os.path.join(processed_dir, "lidar_combined.laz")
+        telemetry = os.path.join(root, "telemetry.jsonl")
+        extent = spec["tiles"] * spec["tile_size"]
+        bounds = ([Config.ORIGIN[0], Config.ORIGIN[0] + extent], [Config.ORIGIN[1], Config.ORIGIN[1] + extent])
+
+        case_args = {
+            "single": (case_process_laz, {
+                "mode": "single", "input_dir": date_dir + "-single",
+                "output_dir": os.path.join(root, "output", "processed", "single"),
+                "tile_size": spec["tile_size"], "parallel": 0, "tiled_hag": False, "telemetry": telemetry}),
+            "separated": (case_process_laz, {
+                "mode": "separated", "input_dir": date_dir, "output_dir": processed_dir,
+                "tile_size": spec["tile_size"], "parallel": 0, "tiled_hag": False, "telemetry": telemetry}),
+            "separated_tiled": (case_process_laz, {
+                "mode": "separated", "input_dir": date_dir,
+                "output_dir": os.path.join(root, "output", "processed", "tiled"),
+                "tile_size": spec["tile_size"], "parallel": 0, "tiled_hag": True, "telemetry": telemetry}),
+            "separated_parallel": (case_process_laz, {
+                "mode": "separated", "input_dir": date_dir,
+                "output_dir": os.path.join(root, "output", "processed", "parallel"),
+                "tile_size": spec["tile_size"], "parallel": Config.PARALLEL, "tiled_hag": True,
+                "telemetry": telemetry}),
+            "rasters": (case_rasters, {
+                "las_file": merged, "output_dir": processed_dir, "bounds": bounds,
+                "resolution": Config.RESOLUTION}),
+            "metrics": (case_metrics, {
+                "las_file": merged, "chm_file": os.path.join(processed_dir, f"chm_{Config.RESOLUTION}.tif")}),
+        }
+
+        for case in cases:
+            func, kwargs = case_args[case]
+            print(f"Running {case} on {size} ({points:,} points)")
+            try:
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    measured = executor.submit(run_case, func, kwargs).result()
+            except Exception as e:
+                print(f"  Error running {case}: {e}")
+                continue
+            record = {
+                "timestamp": datetime.now().isoformat(timespec="seconds"),
+                "revision": revision,
+                "size": size,
+                "format": fmt,
+                "case": case,
+                "points": points,
+                **measured,
+                "points_per_s": round(points / measured["wall_s"]) if measured["wall_s"] > 0 else None,
+            }
+            results.append(record)
+            os.makedirs(os.path.dirname(Config.RESULTS_FILE), exist_ok=True)
+            with open(Config.RESULTS_FILE, "a") as f:
+                f.write(json.dumps(record) + "\n")
+    return results
+
+
+def print_results(results: List[Dict[str, Any]]):
+    print(f"{'size':<8} {'case':<20} {'points':>12} {'wall s':>9} {'pts/s':>12} {'peak MB':>9} {'worker MB':>10}")
+    for r in results:
+        peak = f"{r['peak_rss_mb']:.0f}" if r["peak_rss_mb"] is not None else "-"
+        worker_peak = f"{r['worker_peak_rss_mb']:.0f}" if r.get("worker_peak_rss_mb") else "-"
+        print(f"{r['size']:<8} {r['case']:<20} {r['points']:>12,} {r['wall_s']:>9.2f} "
+              f"{r['points_per_s'] or 0:>12,} {peak:>9} {worker_peak:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the processing pipelines on synthetic surveys.')
+    parser.add_argument('--sizes', nargs='+', choices=list(Config.SIZES), default=["small"],
+                        help='Synthetic survey sizes to run')
+    parser.add_argument('--cases', nargs='+', choices=CASES, default=CASES,
+                        help='Benchmark cases to run (rasters and metrics use the separated output)')
+    parser.add_argument('--format', choices=['las', 'laz', 'xyz'], default=Config.FORMAT,
+                        help='Format of the synthetic tiles')
+    parser.add_argument('--parallel', type=int, default=Config.PARALLEL,
+                        help='Worker processes for the separated_parallel case')
+
+    args = parser.parse_args()
+    Config.PARALLEL = args.parallel
+
+    print_results(run_benchmarks(args.sizes, args.cases, args.format))
+    print(f"Results appended to {Config.RESULTS_FILE}")
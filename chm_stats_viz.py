@@ -9,29 +9,33 @@ def _():
     import polars as pl
     import plotly.express as px
     # from sklearn.linear_model import LinearRegression
-    import numpy as np
-    import statsmodels.api as sm
+    from metrics import grouped_ols
+    from metrics_store import MetricsStore
 
-    return np, pl, px, sm
+    return MetricsStore, grouped_ols, pl, px
 
 
 @app.cell
-def _(pl):
-    # load the chm data
+def _(MetricsStore):
+    # query the chm stats from the metrics store (written by zonal_runner.py)
+    # filters run in DuckDB, so only the rows each view needs are loaded
+    # each query opens and closes the store, so zonal_runner.py can write to it while the app is open
 
-    df = pl.read_parquet("output\\calc_stats\\rehab_chm_stats.parquet")
+    with MetricsStore(read_only=True) as _store:
+        _summary = _store.aggregate(["date"], {"short_id": "count", "p90_height_m": "avg", "woody_cover": "avg"})
 
-    df
-    return (df,)
+    _summary
+    return
 
 
 @app.cell
-def _(df, pl):
+def _(MetricsStore):
     # choose a pre-2015 area
 
-    df_pre_2015 = df.filter(pl.col('short_id') == 'b9ceaa')
+    with MetricsStore(read_only=True) as _store:
+        df_pre_2015 = _store.time_series('b9ceaa')
 
-    df_pre_2015.sort('date')
+    df_pre_2015
     return (df_pre_2015,)
 
 
@@ -67,19 +71,23 @@ def _(df_pre_2015, px):
 
 
 @app.cell
-def _(df, pl, px):
-    _df = (df
-            .filter((pl.col('veg_type') != 'pasture') & (pl.col('rehab_year') < 2021))
-            .sort(by=['short_id', 'date'])
-          )
+def _(MetricsStore):
+    # rehab polygons (no pasture) from before 2021, sorted by short_id and date
+
+    with MetricsStore(read_only=True) as _store:
+        df = _store.select(where="veg_type != 'pasture' AND rehab_year < 2021")
+    return (df,)
+
 
-    _n_categories = _df.select('short_id').unique().height
+@app.cell
+def _(df, px):
+    _n_categories = df.select('short_id').unique().height
     _n_cols = 3  # facet_col_wrap value
     _n_rows = (_n_categories + _n_cols - 1) // _n_cols
 
 
     _fig = px.line(
-        _df
+        df
         , x = 'date'
         , y = 'p90_height_m'
         , facet_col = 'short_id'
@@ -98,7 +106,7 @@ def _(df, pl, px):
 
 
 @app.cell
-def _(df, np, pl, sm):
+def _(df, grouped_ols, pl):
 
 
     # Convert date to numeric (days since epoch) & filter
@@ -107,82 +115,14 @@ def _(df, np, pl, sm):
         .with_columns([
             pl.col("date").dt.epoch(time_unit="d").alias("date_numeric")
         ])
-        .filter((pl.col('veg_type') != 'pasture') & (pl.col('rehab_year') < 2021))
         .filter(pl.col("area_m2_from_chm") > 10000)
     )
-    def fit_ols_regression(group_data):
-        """Fit OLS regression using statsmodels and return key statistics"""
-        # Get the short_id for this group (should be the same for all rows)
-        short_id = group_data["short_id"][0]
-    
-        date_numeric = group_data["date_numeric"].to_numpy()
-        height = group_data["p90_height_m"].to_numpy()
-    
-        if len(date_numeric) < 2:
-            return pl.DataFrame({
-                "short_id": [short_id],
-                "slope_m_per_day": [None],
-                "intercept": [None], 
-                "r_squared": [None],
-                "p_value": [None],
-                "std_error": [None]
-            })
-    
-        # Remove NaN values
-        mask = ~(np.isnan(date_numeric) | np.isnan(height))
-        if mask.sum() < 2:
-            return pl.DataFrame({
-                "short_id": [short_id],
-                "slope_m_per_day": [None],
-                "intercept": [None], 
-                "r_squared": [None],
-                "p_value": [None],
-                "std_error": [None]
-            })
-    
-        date_clean = date_numeric[mask]
-        height_clean = height[mask]
-    
-        # Add constant term for intercept
-        X_with_const = sm.add_constant(date_clean)
-    
-        try:
-            # Fit the model
-            model = sm.OLS(height_clean, X_with_const)
-            results = model.fit()
-        
-            # Extract results
-            intercept = results.params[0]
-            slope = results.params[1]
-            r_squared = results.rsquared
-            p_value = results.pvalues[1]  # p-value for the slope
-            std_err = results.bse[1]  # standard error for the slope
-        
-            return pl.DataFrame({
-                "short_id": [short_id],
-                "slope_m_per_day": [slope],
-                "intercept": [intercept], 
-                "r_squared": [r_squared],
-                "p_value": [p_value],
-                "std_error": [std_err]
-            })
-        except:
-            return pl.DataFrame({
-                "short_id": [short_id],
-                "slope_m_per_day": [None],
-                "intercept": [None], 
-                "r_squared": [None],
-                "p_value": [None],
-                "std_error": [None]
-            })
-
     df_with_numeric_date
 
-    # Apply OLS regression for each short_id
+    # OLS of P90 height against date for every short_id at once (closed form, see metrics.grouped_ols)
     results = (
-        df_with_numeric_date
-        .group_by("short_id")
-        .map_groups(fit_ols_regression)
+        grouped_ols(df_with_numeric_date, "short_id", "date_numeric", "p90_height_m")
+        .rename({"slope": "slope_m_per_day"})
         .with_columns([
             # Convert slope from m/day to m/year
             (pl.col("slope_m_per_day") * 365.25).alias("growth_rate_m_per_year"),
@@ -208,6 +148,22 @@ def _(df, np, pl, sm):
     return (res,)
 
 
+@app.cell
+def _(df, grouped_ols, pl):
+    # growth rate of every metric for every polygon in one call - one row per short_id and metric
+
+    growth_by_metric = (
+        grouped_ols(
+            df.with_columns(pl.col("date").dt.epoch(time_unit="d").alias("date_numeric")),
+            "short_id", "date_numeric", ["p90_height_m", "mean_height_m", "woody_cover"]
+        )
+        .with_columns((pl.col("slope") * 365.25).alias("rate_per_year"))
+    )
+
+    growth_by_metric
+    return
+
+
 @app.cell
 def _(px, res):
     px.scatter(
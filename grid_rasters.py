@@ -0,0 +1,277 @@
+# imports
+import os
+import time
+import argparse
+from typing import Dict, List, Tuple
+
+import numpy as np
+import laspy
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.crs import CRS
+
+from nodata_fill import fill_nodata
+
+
+#############################################
+# DSM, DTM and CHM from one streaming pass over a LAS/LAZ file, gridded in memory
+#############################################
+
+# Configuration section - edit these settings as needed
+class Config:
+    RESOLUTION = 0.25  # metres
+    BOUNDS = ([295000, 298000], [6425000, 6429000])  # ([minx, maxx], [miny, maxy]), None for the file bounds
+    CHUNK_SIZE = 1_000_000  # Points per laspy chunk
+    AUTOTUNE = True  # Use the gridding chunk size persisted by autotune.py for this machine and dataset, if tuned
+    GROUND_CLASS = 2
+    FILL_MAX_DISTANCE = 20  # Pixels searched to fill DTM gaps (gdal_fillnodata -md)
+    FILL_TILE_SIZE = 1024  # Pixels per fill tile, each read with FILL_MAX_DISTANCE overlap
+    FILL_WORKERS = os.cpu_count() or 1  # Processes filling tiles in parallel
+    NODATA = -9999.0
+    WRITE_RAW_DTM = False  # Also write the DTM before gap filling (dtm_<res>.tif)
+
+
+# only decode what the surfaces need (LAZ 1.4 files, other files are read in full)
+SURFACE_SELECTION = (laspy.DecompressionSelection.XY_RETURNS_CHANNEL | laspy.DecompressionSelection.Z |
+                     laspy.DecompressionSelection.CLASSIFICATION)
+
+
+class SurfaceGrid:
+    """
+    DSM (max Z of all points) and DTM (min Z of ground points) accumulators on one grid.
+
+    The grid follows writers.gdal: width = (maxx - minx) / resolution + 1 cells from
+    minx, and the same for the height from miny, with row 0 at the top. Each point goes
+    in the cell that contains it, like writers.gdal with binmode, rather than every
+    cell within the radius. Cells are counted from (minx, miny), so a grid whose
+    resolution is a whole multiple of another's lines up with it cell for cell.
+    """
+
+    def __init__(self, bounds: Tuple[Tuple[float, float], Tuple[float, float]], resolution: float,
+                 allocate: bool = True):
+        (self.min_x, max_x), (self.min_y, max_y) = bounds
+        self.resolution = resolution
+        self.width = int((max_x - self.min_x) / resolution) + 1
+        self.height = int((max_y - self.min_y) / resolution) + 1
+        self.top = self.min_y + self.height * resolution
+        self.transform = from_origin(self.min_x, self.top, resolution, resolution)
+        if allocate:
+            self.dsm = np.full(self.height * self.width, -np.inf, dtype=np.float32)
+            self.dtm = np.full(self.height * self.width, np.inf, dtype=np.float32)
+
+    def cells(self, x: np.ndarray, y: np.ndarray):
+        """Linear cell index of each point, and which points are on the grid."""
+        col = np.floor((x - self.min_x) / self.resolution).astype(np.int64)
+        row = self.height - 1 - np.floor((y - self.min_y) / self.resolution).astype(np.int64)
+        inside = (col >= 0) & (col < self.width) & (row >= 0) & (row < self.height)
+        return row * self.width + col, inside
+
+    def add(self, x: np.ndarray, y: np.ndarray, z: np.ndarray, ground: np.ndarray):
+        cells, inside = self.cells(x, y)
+        np.maximum.at(self.dsm, cells[inside], z[inside])
+        ground = ground & inside
+        np.minimum.at(self.dtm, cells[ground], z[ground])
+
+    def derive(self, resolution: float, bounds) -> "SurfaceGrid":
+        """
+        A coarser grid built from this one without the points - max/min of max/min is
+        the max/min, so each coarse cell reduces the block of fine cells it covers.
+        resolution must be a whole multiple of this grid's.
+        """
+        factor = int(round(resolution / self.resolution))
+        coarse = SurfaceGrid(bounds, resolution, allocate=False)
+        for name, fill, reduce in [("dsm", -np.inf, np.max), ("dtm", np.inf, np.min)]:
+            # rows counted up from miny so the blocks line up with the coarse cells
+            fine = getattr(self, name).reshape(self.height, self.width)[::-1]
+            padded = np.full((coarse.height * factor, coarse.width * factor), fill, dtype=np.float32)
+            rows, cols = min(fine.shape[0], padded.shape[0]), min(fine.shape[1], padded.shape[1])
+            padded[:rows, :cols] = fine[:rows, :cols]
+            blocks = padded.reshape(coarse.height, factor, coarse.width, factor)
+            setattr(coarse, name, np.ascontiguousarray(reduce(blocks, axis=(1, 3))[::-1]).ravel())
+        return coarse
+
+    def surfaces(self, nodata: float = None) -> Tuple[np.ndarray, np.ndarray]:
+        """The DSM and DTM as 2D arrays, nodata where a cell had no points."""
+        nodata = Config.NODATA if nodata is None else nodata
+        dsm = np.where(np.isfinite(self.dsm), self.dsm, nodata).reshape(self.height, self.width)
+        dtm = np.where(np.isfinite(self.dtm), self.dtm, nodata).reshape(self.height, self.width)
+        return dsm, dtm
+
+
+def file_bounds(input_file: str) -> Tuple[Tuple[float, float], Tuple[float, float]]:
+    with laspy.open(input_file) as reader:
+        mins, maxs = reader.header.mins, reader.header.maxs
+    return (float(mins[0]), float(maxs[0])), (float(mins[1]), float(maxs[1]))
+
+
+def file_crs(input_file: str):
+    with laspy.open(input_file) as reader:
+        try:
+            crs = reader.header.parse_crs()
+        except Exception:
+            crs = None
+    return CRS.from_wkt(crs.to_wkt()) if crs is not None else None
+
+
+def tuned_chunk_size(input_file: str) -> int:
+    """
+    The gridding chunk size autotune.py persisted for this machine and the input's
+    dataset profile, else Config.CHUNK_SIZE. This is tuned separately from the PDAL
+    streaming chunk size, which is far too small for laspy chunks and numpy binning.
+    """
+    if Config.AUTOTUNE:
+        from autotune import load_settings  # imports pdal, so only when tuning is on
+        settings = load_settings(input_file) or {}
+        if "grid_chunk_size" in settings:
+            print(f"Using tuned settings: CHUNK_SIZE={settings['grid_chunk_size']}")
+            return settings["grid_chunk_size"]
+    return Config.CHUNK_SIZE
+
+
+def grid_points(input_file: str, grids: List[SurfaceGrid], chunk_size: int = None, ground_class: int = None,
+                max_points: int = None) -> int:
+    """
+    Stream the points of a LAS/LAZ file into one or more grids. Returns the number of points read.
+    chunk_size defaults to the tuned chunk size (see tuned_chunk_size). max_points stops
+    after that many points (in whole chunks), for calibration runs.
+    """
+    chunk_size = chunk_size or tuned_chunk_size(input_file)
+    ground_class = Config.GROUND_CLASS if ground_class is None else ground_class
+    count = 0
+    with laspy.open(input_file, decompression_selection=SURFACE_SELECTION) as reader:
+        for points in reader.chunk_iterator(chunk_size):
+            x, y, z = np.asarray(points.x), np.asarray(points.y), np.asarray(points.z)
+            ground = np.asarray(points.classification) == ground_class
+            for grid in grids:
+                grid.add(x, y, z, ground)
+            count += len(points)
+            if max_points is not None and count >= max_points:
+                break
+    return count
+
+
+def plan_resolutions(resolutions: List[float]) -> Dict[float, float]:
+    """
+    Decide how each resolution is built: from the points (mapped to None), or derived
+    from the finer resolution it is a whole multiple of (mapped to that resolution).
+    """
+    plan = {}
+    for resolution in sorted(set(resolutions)):
+        bases = [r for r in plan if plan[r] is None and
+                 abs(resolution / r - round(resolution / r)) < 1e-6 and round(resolution / r) > 1]
+        plan[resolution] = max(bases) if bases else None
+    return plan
+
+
+def fill_dtm(dtm: np.ndarray, max_distance: float = None, nodata: float = None) -> np.ndarray:
+    """
+    Fill the DTM gaps in process, as gdal_fillnodata -md max_distance: GDAL's FillNodata
+    run tile by tile in parallel processes (see nodata_fill.py), which gives the same
+    raster as filling the whole DTM at once.
+    """
+    max_distance = Config.FILL_MAX_DISTANCE if max_distance is None else max_distance
+    nodata = Config.NODATA if nodata is None else nodata
+    return fill_nodata(dtm, nodata, max_distance, tile_size=Config.FILL_TILE_SIZE, workers=Config.FILL_WORKERS)
+
+
+def canopy_height(dsm: np.ndarray, dtm: np.ndarray, nodata: float = None) -> np.ndarray:
+    """DSM - DTM, nodata where either is nodata (as gdal_calc --NoDataValue)."""
+    nodata = Config.NODATA if nodata is None else nodata
+    return np.where((dsm != nodata) & (dtm != nodata), dsm - dtm, nodata).astype(np.float32)
+
+
+def write_raster(path: str, array: np.ndarray, grid: SurfaceGrid, crs, nodata: float = None):
+    """Write a single band float32 tiled GeoTIFF on the grid."""
+    nodata = Config.NODATA if nodata is None else nodata
+    profile = {
+        "driver": "GTiff",
+        "width": grid.width,
+        "height": grid.height,
+        "count": 1,
+        "dtype": "float32",
+        "crs": crs,
+        "transform": grid.transform,
+        "nodata": nodata,
+        "tiled": True,
+        "blockxsize": 512,
+        "blockysize": 512,
+        "compress": "deflate",
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(array.astype(np.float32), 1)
+
+
+def write_products(grid: SurfaceGrid, crs, output_dir: str) -> Dict[str, str]:
+    """Fill the DTM gaps and write dsm_<res>.tif, dtm_filled_<res>.tif and chm_<res>.tif for one grid."""
+    resolution = grid.resolution
+    dsm, dtm = grid.surfaces()
+    paths = {
+        "dsm": os.path.join(output_dir, f"dsm_{resolution}.tif"),
+        "dtm_filled": os.path.join(output_dir, f"dtm_filled_{resolution}.tif"),
+        "chm": os.path.join(output_dir, f"chm_{resolution}.tif"),
+    }
+    if Config.WRITE_RAW_DTM:
+        paths["dtm"] = os.path.join(output_dir, f"dtm_{resolution}.tif")
+        write_raster(paths["dtm"], dtm, grid, crs)
+    dtm = fill_dtm(dtm)
+    write_raster(paths["dsm"], dsm, grid, crs)
+    write_raster(paths["dtm_filled"], dtm, grid, crs)
+    write_raster(paths["chm"], canopy_height(dsm, dtm), grid, crs)
+    return paths
+
+
+def generate_multi_resolution(input_file: str, resolutions: List[float], bounds=None, output_dir: str = None,
+                              chunk_size: int = None) -> Dict[float, Dict[str, str]]:
+    """
+    Generate the rasters at several resolutions from one read of the points. Only the
+    resolutions that aren't a whole multiple of a finer one are gridded from the points
+    (e.g. 0.1 and 0.25 for 0.1, 0.2, 0.25, 0.5, 1); the rest are reduced from them.
+    Returns the paths written per resolution.
+    """
+    bounds = bounds or Config.BOUNDS or file_bounds(input_file)
+    output_dir = output_dir or os.path.dirname(input_file)
+    plan = plan_resolutions(resolutions)
+
+    start_time = time.time()
+    grids = {r: SurfaceGrid(bounds, r) for r, base in plan.items() if base is None}
+    print(f"Gridding {input_file} at {', '.join(f'{r} m' for r in grids)}")
+    count = grid_points(input_file, list(grids.values()), chunk_size)
+    print(f"  {count:,} points gridded ({time.time() - start_time:.1f}s)")
+
+    crs = file_crs(input_file)
+    paths = {}
+    # coarsest first, so each fine grid is kept only until the last grid derived from it
+    for resolution in sorted(plan, reverse=True):
+        base = plan[resolution]
+        grid = grids[resolution] if base is None else grids[base].derive(resolution, bounds)
+        paths[resolution] = write_products(grid, crs, output_dir)
+        print(f"  {resolution} m rasters written ({grid.width} x {grid.height}, "
+              f"{'gridded' if base is None else f'from {base} m'}, {time.time() - start_time:.1f}s)")
+        if base is None:
+            del grids[resolution]
+    return paths
+
+
+def generate_rasters(input_file: str, resolution: float = None, bounds=None, output_dir: str = None,
+                     chunk_size: int = None) -> Dict[str, str]:
+    """
+    Grid the DSM and ground DTM in one pass over input_file, fill the DTM gaps and
+    write dsm_<res>.tif, dtm_filled_<res>.tif and chm_<res>.tif next to it (or in
+    output_dir). Returns the paths written.
+    """
+    resolution = resolution or Config.RESOLUTION
+    return generate_multi_resolution(input_file, [resolution], bounds, output_dir, chunk_size)[resolution]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate the DSM, DTM and CHM rasters in one pass over a LAS/LAZ file.')
+    parser.add_argument('input', help='Merged LAS/LAZ file, e.g. output/processed/<date>/lidar_combined.laz')
+    parser.add_argument('--resolution', type=float, nargs='+', default=[Config.RESOLUTION],
+                        help='Pixel size(s) in metres - several are generated from one read of the points')
+    parser.add_argument('--output', help='Output folder (default the input file\'s folder)')
+    parser.add_argument('--file-bounds', action='store_true', help='Use the file bounds instead of Config.BOUNDS')
+
+    args = parser.parse_args()
+    if args.file_bounds:
+        Config.BOUNDS = None
+    generate_multi_resolution(args.input, args.resolution, output_dir=args.output)
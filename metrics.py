@@ -1,30 +1,30 @@
 # chm_metrics.py
 import numpy as np
-import rasterio
-import laspy
 import pandas as pd
+import polars as pl
 import matplotlib.pyplot as plt
 from pathlib import Path
+from spatial_lib import grid_cell_stem_proxy
+from zonal import grouped_chm_stats
 
 ###############################################################################
 # 1. QUICK METRICS FROM THE CHM (GeoTIFF, 1m pixels)
 ###############################################################################
 
-def chm_summary(chm_path: Path):
+def chm_summary(chm_path: Path, memory_mb=None):
     """Return % woody cover > 1 m, mean height, P90 height."""
-    with rasterio.open(chm_path) as src:
-        chm = src.read(1, masked=True)          # 2-D masked array, metres
-    woody_mask = chm > 1                        # dense-woody threshold
-    pct_woody = woody_mask.mean() * 100         # % of raster area
-    mean_h     = float(chm.mean())              # metres
-    p90_h      = float(np.percentile(chm.compressed(), 90))
+    # read in strips of blocks within memory_mb, same result as reading the whole band
+    stats = grouped_chm_stats(str(chm_path), qs=[90], positive_only=False, memory_mb=memory_mb)
+    pct_woody = stats["woody_cover"][0] * 100   # % of raster area
+    mean_h     = float(stats["mean"][0])        # metres
+    p90_h      = float(stats["p90"][0])
     return pct_woody, mean_h, p90_h
 
 ###############################################################################
 # 2. STEM-DENSITY PROXY FROM THE POINT CLOUD (HeightAboveGround already added)
 ###############################################################################
 
-def stem_density(las_path: Path, grid=2.0):
+def stem_density(las_path: Path, grid=2.0, bounds=None, polygon=None):
     """
     Very lightweight stem-density proxy:
       • keep points with HeightAboveGround>2m (ignore grass/shrub noise)
@@ -32,28 +32,9 @@ def stem_density(las_path: Path, grid=2.0):
       • assume one stem/cluster per occupied cell
       • report stemsha⁻¹
     """
-    las = laspy.read(las_path)
-    try:
-        hag = las['HeightAboveGround']          # PDAL wrote this extra dim
-    except KeyError:
-        raise RuntimeError("LAS file missing HeightAboveGround dimension")
-
-    mask = hag > 2                              # metres
-    if mask.sum() == 0:
-        return 0.0
-
-    x = las.x[mask]
-    y = las.y[mask]
-
-    # snap to grid
-    gx = np.floor((x - x.min()) / grid).astype(np.int32)
-    gy = np.floor((y - y.min()) / grid).astype(np.int32)
-    occupied = np.unique(np.stack([gx, gy], axis=1), axis=0).shape[0]
-
-    # area covered = raster footprint (min→max) so density is consistent
-    area_m2 = (x.max() - x.min()) * (y.max() - y.min())
-    area_ha = area_m2 / 10_000
-    return occupied / area_ha                  # stems per hectare
+    # streamed in chunks, decoding only X, Y and HeightAboveGround
+    # bounds / polygon (e.g. one rehab polygon) read only the chunks or COPC nodes they overlap
+    return grid_cell_stem_proxy(str(las_path), grid=grid, height_cutoff=2, bounds=bounds, polygon=polygon)
 
 ###############################################################################
 # 3. WRAP EVERYTHING FOR ONE DATE (EXTEND TO MANY DATES AS NEEDED)
@@ -71,7 +52,81 @@ def analyse_block(date, chm_path, las_path):
     }
 
 ###############################################################################
-# 4. EXAMPLE USAGE
+# 4. GROWTH RATES - OLS OF A METRIC AGAINST TIME FOR EVERY POLYGON AT ONCE
+###############################################################################
+
+def grouped_ols(df: pl.DataFrame, by, x: str, y) -> pl.DataFrame:
+    """
+    Simple linear regression y = intercept + slope * x for every group at once,
+    from grouped sums instead of one statsmodels.OLS fit per group.
+
+    by is a column or list of columns, y a column or list of columns (one fit per
+    group per column, with a "metric" column naming it). Rows with a null or NaN
+    x or y are dropped, as in fit_ols_regression. The sums are taken about each
+    group's means and the residuals are summed directly, so the results match
+    statsmodels: slope, intercept, r_squared, std_error (of the slope) and p_value
+    (two sided t test of the slope, n - 2 degrees of freedom). Groups with fewer
+    than 2 points or a single x get nulls; with exactly 2, std_error and p_value
+    are null.
+    """
+    from scipy import stats as scipy_stats
+
+    groups = [by] if isinstance(by, str) else list(by)
+    if isinstance(y, str):
+        data = df.select([*groups, pl.col(x).alias("x"), pl.col(y).alias("y")])
+    else:
+        groups = [*groups, "metric"]
+        data = df.unpivot(index=[*groups[:-1], x], on=list(y), variable_name="metric", value_name="y").rename({x: "x"})
+    all_groups = data.select(groups).unique()
+
+    sums = (data.lazy()
+            .with_columns([pl.col("x").cast(pl.Float64), pl.col("y").cast(pl.Float64)])
+            .drop_nulls(["x", "y"])
+            .filter(pl.col("x").is_not_nan() & pl.col("y").is_not_nan())
+            .with_columns([
+                (pl.col("x") - pl.col("x").mean().over(groups)).alias("dx"),
+                (pl.col("y") - pl.col("y").mean().over(groups)).alias("dy"),
+            ])
+            .with_columns(
+                ((pl.col("dx") * pl.col("dy")).sum().over(groups) / (pl.col("dx") ** 2).sum().over(groups)).alias("b")
+            )
+            .group_by(groups)
+            .agg([
+                pl.len().alias("n"),
+                pl.col("x").mean().alias("x_mean"),
+                pl.col("y").mean().alias("y_mean"),
+                (pl.col("dx") ** 2).sum().alias("sxx"),
+                (pl.col("dx") * pl.col("dy")).sum().alias("sxy"),
+                (pl.col("dy") ** 2).sum().alias("syy"),
+                ((pl.col("dy") - pl.col("b") * pl.col("dx")) ** 2).sum().alias("ssr"),
+            ])
+            .collect())
+
+    n = sums["n"].to_numpy().astype(np.float64)
+    sxx, sxy, syy, ssr = (sums[c].to_numpy() for c in ["sxx", "sxy", "syy", "ssr"])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fit = (n >= 2) & (sxx > 0)
+        slope = np.where(fit, sxy / sxx, np.nan)
+        intercept = np.where(fit, sums["y_mean"].to_numpy() - slope * sums["x_mean"].to_numpy(), np.nan)
+        r_squared = np.where(fit, 1 - ssr / syy, np.nan)
+        df_resid = n - 2
+        std_error = np.where(fit & (df_resid > 0), np.sqrt(ssr / np.maximum(df_resid, 1) / sxx), np.nan)
+        t = slope / std_error
+        p_value = np.where(np.isnan(t), np.nan, 2 * scipy_stats.t.sf(np.abs(t), np.maximum(df_resid, 1)))
+
+    result = sums.select(groups).with_columns([
+        pl.Series("slope", slope, nan_to_null=True),
+        pl.Series("intercept", intercept, nan_to_null=True),
+        pl.Series("r_squared", r_squared, nan_to_null=True),
+        pl.Series("p_value", p_value, nan_to_null=True),
+        pl.Series("std_error", std_error, nan_to_null=True),
+        sums["n"],
+    ])
+    # groups with no usable rows get a row of nulls
+    return all_groups.join(result, on=groups, how="left").sort(groups)
+
+###############################################################################
+# 5. EXAMPLE USAGE
 ###############################################################################
 
 if __name__ == "__main__":
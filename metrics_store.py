@@ -0,0 +1,138 @@
+# imports
+import os
+from typing import Any, Dict, List
+
+import duckdb
+import polars as pl
+
+STORE_FILE = os.path.join("output", "calc_stats", "rehab_metrics.duckdb")
+KEY_COLUMNS = ["date", "short_id", "metric_version"]
+CHM_TABLE = "chm_stats"  # zonal.chm_stats rows
+POINT_TABLE = "point_stats"  # point_zonal.point_stats rows
+
+
+class MetricsStore:
+    """
+    DuckDB file of the per-polygon metrics, one table per source (CHM, point cloud).
+
+    Rows are keyed by (date, short_id, metric_version): upserting a rerun of a date
+    replaces its rows instead of adding duplicates, and rows from an older
+    metric_version stay until they are dropped. Queries filter and aggregate in
+    DuckDB and only return the rows asked for, by default from the latest
+    metric_version of each (date, short_id).
+
+        with MetricsStore() as store:
+            store.upsert(chm_stats_df, version=STATS_VERSION)
+            store.time_series("b9ceaa")
+    """
+
+    def __init__(self, path: str = STORE_FILE, read_only: bool = False):
+        self.path = path
+        if not read_only:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.con = duckdb.connect(path, read_only=read_only)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.con.close()
+
+    def tables(self) -> List[str]:
+        return [row[0] for row in self.con.execute("SELECT table_name FROM information_schema.tables").fetchall()]
+
+    def columns(self, table: str) -> List[str]:
+        return [row[0] for row in self.con.execute(f'DESCRIBE "{table}"').fetchall()]
+
+    def upsert(self, df: pl.DataFrame, version: int, table: str = CHM_TABLE) -> int:
+        """
+        Write the rows of df (date as a Date, short_id, and metric columns) under
+        metric_version = version. Each date in df replaces all of that date's rows
+        under the version, so polygons no longer in the date's results don't linger.
+        The table is created from the first frame written to it and new columns are
+        added as they appear. Returns the rows written.
+        """
+        if df.is_empty():
+            return 0
+        # a rerun within df itself keeps its last row
+        df = df.with_columns(pl.lit(version, dtype=pl.Int32).alias("metric_version")).unique(
+            subset=KEY_COLUMNS, keep="last", maintain_order=True)
+        self.con.register("incoming", df.to_arrow())
+        try:
+            incoming = [(row[0], row[1]) for row in self.con.execute("DESCRIBE incoming").fetchall()]
+            if table not in self.tables():
+                columns = ", ".join(f'"{name}" {dtype}' for name, dtype in incoming)
+                self.con.execute(f'CREATE TABLE "{table}" ({columns}, PRIMARY KEY ({", ".join(KEY_COLUMNS)}))')
+            existing = set(self.columns(table))
+            for name, dtype in incoming:
+                if name not in existing:
+                    self.con.execute(f'ALTER TABLE "{table}" ADD COLUMN "{name}" {dtype}')
+            # short_ids come from the polygon centroids, so an edited polygon's old rows must go
+            self.con.execute(f'DELETE FROM "{table}" WHERE metric_version = ? '
+                             'AND date IN (SELECT DISTINCT date FROM incoming)', [version])
+            self.con.execute(f'INSERT OR REPLACE INTO "{table}" BY NAME SELECT * FROM incoming')
+        finally:
+            self.con.unregister("incoming")
+        return df.height
+
+    def dates(self, version: int, table: str = CHM_TABLE) -> List[str]:
+        """The dates (YYYY-MM-DD) stored under a metric_version."""
+        if table not in self.tables():
+            return []
+        rows = self.con.execute(f'SELECT DISTINCT strftime(date, \'%Y-%m-%d\') FROM "{table}" '
+                                'WHERE metric_version = ? ORDER BY 1', [version]).fetchall()
+        return [row[0] for row in rows]
+
+    def query(self, sql: str, params: List[Any] = None) -> pl.DataFrame:
+        """Run any SQL against the store and return the result as a Polars DataFrame."""
+        return self.con.execute(sql, params or []).pl()
+
+    def rows_sql(self, table: str, where: str = None, params: List[Any] = None, version: int = None):
+        """SQL and params for the rows matching where - one version's, or the latest of each (date, short_id)."""
+        params = list(params or [])
+        filters = [f"({where})"] if where else []
+        if version is not None:
+            filters.append("metric_version = ?")
+            params.append(version)
+        sql = f'SELECT * FROM "{table}"'
+        if filters:
+            sql += " WHERE " + " AND ".join(filters)
+        if version is None:
+            sql += " QUALIFY row_number() OVER (PARTITION BY date, short_id ORDER BY metric_version DESC) = 1"
+        return sql, params
+
+    def select(self, table: str = CHM_TABLE, where: str = None, params: List[Any] = None, columns: List[str] = None,
+               version: int = None) -> pl.DataFrame:
+        """
+        Rows of a table matching a SQL where clause (with ? params), sorted by short_id
+        and date. version picks one metric_version, otherwise each (date, short_id)
+        comes from its latest version.
+        """
+        rows, params = self.rows_sql(table, where, params, version)
+        select = ", ".join(f'"{c}"' for c in columns) if columns else "* EXCLUDE (metric_version)"
+        return self.query(f"SELECT {select} FROM ({rows}) ORDER BY short_id, date", params)
+
+    def time_series(self, short_id: str, table: str = CHM_TABLE, columns: List[str] = None,
+                    version: int = None) -> pl.DataFrame:
+        """Every date of one polygon."""
+        return self.select(table, "short_id = ?", [short_id], columns, version)
+
+    def rehab_year(self, rehab_year: int, table: str = CHM_TABLE, columns: List[str] = None,
+                   version: int = None) -> pl.DataFrame:
+        """Every polygon and date of one rehab year."""
+        return self.select(table, "rehab_year = ?", [rehab_year], columns, version)
+
+    def aggregate(self, by: List[str], metrics: Dict[str, str], table: str = CHM_TABLE, where: str = None,
+                  params: List[Any] = None, version: int = None) -> pl.DataFrame:
+        """
+        Aggregate the latest rows (or one version's) in DuckDB, e.g.
+        aggregate(["rehab_year", "date"], {"p90_height_m": "avg", "short_id": "count"}).
+        Result columns are named <metric>_<function>.
+        """
+        rows, params = self.rows_sql(table, where, params, version)
+        group = ", ".join(f'"{c}"' for c in by)
+        aggregates = ", ".join(f'{func}("{metric}") AS "{metric}_{func}"' for metric, func in metrics.items())
+        return self.query(f"SELECT {group}, {aggregates} FROM ({rows}) GROUP BY {group} ORDER BY {group}", params)
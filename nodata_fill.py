@@ -0,0 +1,81 @@
+# imports
+import multiprocessing
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple
+
+import numpy as np
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.fill import fillnodata
+
+
+def fill_block(block: np.ndarray, valid: np.ndarray, max_distance: float) -> np.ndarray:
+    """
+    Fill the invalid pixels of one block with GDAL's FillNodata (as gdal_fillnodata -md),
+    searching up to max_distance pixels. rasterio fills the array it is given, so the
+    block is copied first. Pixels with no valid pixel in range stay as they were.
+    """
+    with warnings.catch_warnings():
+        # a bare array has no transform, which FillNodata doesn't need
+        warnings.simplefilter("ignore", NotGeoreferencedWarning)
+        return fillnodata(block.copy(), mask=valid, max_search_distance=max_distance)
+
+
+def fill_tile(block: np.ndarray, valid: np.ndarray, max_distance: float,
+              core: Tuple[slice, slice]) -> np.ndarray:
+    """Fill a tile read with its overlap and return only its core. Executed in a worker process."""
+    return fill_block(block, valid, max_distance)[core]
+
+
+def fill_nodata(array: np.ndarray, nodata: float, max_distance: float = 20, tile_size: int = 1024,
+                workers: int = None) -> np.ndarray:
+    """
+    Fill nodata gaps in a 2D array the way gdal_fillnodata -md does, e.g. the DTM before the CHM.
+
+    The array is split into tile_size tiles, each filled by GDAL's FillNodata with an
+    overlap of max_distance pixels. A pixel is only filled from the valid pixels within
+    max_distance of it, so every tile sees the same neighbours as a whole-array fill and
+    the result is the same. rasterio holds the GIL while GDAL fills, so the tiles are
+    filled in worker processes, a few tiles per worker in flight at a time. Returns a
+    filled copy of the array.
+    """
+    workers = workers or os.cpu_count() or 1
+    valid = array != nodata
+    if np.isnan(nodata):
+        valid = ~np.isnan(array)
+    if valid.all() or not valid.any():
+        return array.copy()
+    halo = int(np.ceil(max_distance))
+    rows, cols = array.shape
+    result = array.copy()
+
+    def tiles():
+        """(core slices in the array, overlap slices in the array, core slices in the overlap) of the tiles with gaps."""
+        for row in range(0, rows, tile_size):
+            for col in range(0, cols, tile_size):
+                core = (slice(row, min(row + tile_size, rows)), slice(col, min(col + tile_size, cols)))
+                r0, c0 = max(row - halo, 0), max(col - halo, 0)
+                r1, c1 = min(row + tile_size + halo, rows), min(col + tile_size + halo, cols)
+                outer = (slice(r0, r1), slice(c0, c1))
+                if valid[core].all() or not valid[outer].any():
+                    continue
+                yield core, outer, (slice(row - r0, core[0].stop - r0), slice(col - c0, core[1].stop - c0))
+
+    if workers == 1:
+        for core, outer, inner in tiles():
+            result[core] = fill_tile(array[outer], valid[outer], max_distance, inner)
+        return result
+
+    # spawned, not forked - the caller may have decoder threads running (e.g. laspy's LAZ backend)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        pending = {}
+        for core, outer, inner in tiles():
+            pending[executor.submit(fill_tile, array[outer], valid[outer], max_distance, inner)] = core
+            # only a few tiles per worker are copied to the workers at a time
+            if len(pending) >= 2 * workers:
+                future = next(iter(pending))
+                result[pending.pop(future)] = future.result()
+        for future, core in pending.items():
+            result[core] = future.result()
+    return result
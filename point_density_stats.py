@@ -1,8 +1,8 @@
-import json, subprocess, math
+from point_profile import point_profile
 
-info = subprocess.check_output(
-    ["pdal", "info", "--summary", "output/rehab_sample_hag.laz"]
-)
-density = json.loads(info)["summary"]["density"]  # points per m²
-opt_cell = round(1 / math.sqrt(density), 2)  # ≈ average spacing
-print(f"Average spacing ≈ {opt_cell} m")
+# header and a small sample only - cached per file, no full read or pdal subprocess
+profile = point_profile("output/rehab_sample_hag.laz")
+density = profile["density_per_m2"]  # points per m²
+opt_cell = round(profile["spacing_m"], 2)  # ≈ average spacing
+print(f"Average spacing ≈ {opt_cell} m")
+print(f"Spacing where there is data ≈ {profile['occupied_spacing_m']:.2f} m")
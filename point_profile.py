@@ -0,0 +1,129 @@
+# imports
+import os
+import json
+import math
+import argparse
+from typing import Any, Dict
+
+import numpy as np
+import laspy
+
+PROFILE_CACHE_FILE = os.path.join("output", "cache", "point_profiles.json")
+SAMPLE_CHUNKS = 8  # Evenly spaced runs of points read for the sampled estimates
+SAMPLE_POINTS = 50_000  # Points per run (about one LAZ chunk)
+OCCUPANCY_CELL = 1.0  # metres - cell size for the occupied area estimate
+
+
+def header_profile(header) -> Dict[str, Any]:
+    """Everything that can be answered from the LAS header alone."""
+    area_m2 = float((header.maxs[0] - header.mins[0]) * (header.maxs[1] - header.mins[1]))
+    density = header.point_count / area_m2 if area_m2 > 0 else None
+    try:
+        crs = header.parse_crs()
+    except Exception:
+        crs = None
+    return {
+        "point_count": int(header.point_count),
+        "min_x": float(header.mins[0]), "min_y": float(header.mins[1]), "min_z": float(header.mins[2]),
+        "max_x": float(header.maxs[0]), "max_y": float(header.maxs[1]), "max_z": float(header.maxs[2]),
+        "area_m2": area_m2,
+        "density_per_m2": density,
+        "spacing_m": 1 / math.sqrt(density) if density else None,
+        "dimensions": list(header.point_format.dimension_names),
+        "point_format": header.point_format.id,
+        "version": str(header.version),
+        "crs": crs.to_string() if crs is not None else None,
+        "points_by_return": [int(n) for n in header.number_of_points_by_return],
+    }
+
+
+def sample_profile(reader, sample_chunks: int, sample_points: int, cell: float) -> Dict[str, Any]:
+    """
+    Estimate the class counts and the real (occupied) density from a few evenly spaced
+    runs of points. LAZ readers seek straight to the chunk holding a point, so only the
+    sampled chunks are decompressed.
+
+    Each run of consecutive points covers a small patch of the survey, so the points in
+    a run over the area of the cell x cell cells they occupy is the density where
+    there is data - unlike the header density, gaps and the empty corners of the
+    bounding box don't dilute it.
+    """
+    point_count = reader.header.point_count
+    runs = min(sample_chunks, max(point_count // max(sample_points, 1), 1))
+    starts = np.linspace(0, max(point_count - sample_points, 0), runs).astype(np.int64)
+    class_counts = np.zeros(256, dtype=np.int64)
+    sampled = 0
+    occupied_m2 = 0.0
+    for start in starts:
+        reader.seek(int(start))
+        points = reader.read_points(sample_points)
+        if len(points) == 0:
+            continue
+        class_counts += np.bincount(np.asarray(points.classification), minlength=256)
+        cells = np.unique(np.stack([np.floor(np.asarray(points.x) / cell), np.floor(np.asarray(points.y) / cell)]),
+                          axis=1)
+        occupied_m2 += cells.shape[1] * cell * cell
+        sampled += len(points)
+    if not sampled:
+        return {"sampled_points": 0, "class_counts": {}, "occupied_density_per_m2": None, "occupied_spacing_m": None}
+    density = sampled / occupied_m2
+    scale = point_count / sampled
+    return {
+        "sampled_points": sampled,
+        # estimated from the sample - read_las_info in tile_index.py counts them exactly
+        "class_counts": {str(c): int(round(n * scale)) for c, n in enumerate(class_counts) if n},
+        "occupied_density_per_m2": density,
+        "occupied_spacing_m": 1 / math.sqrt(density),
+    }
+
+
+def point_profile(path: str, sample_chunks: int = SAMPLE_CHUNKS, sample_points: int = SAMPLE_POINTS,
+                  cell: float = OCCUPANCY_CELL, cache_file: str = PROFILE_CACHE_FILE) -> Dict[str, Any]:
+    """
+    Profile a LAS/LAZ file: point count, bounds, header density and spacing, dimensions,
+    CRS and returns from the header, plus sampled class counts and occupied density.
+    Cached per file, keyed by size and mtime, so repeat calls don't open the file.
+    """
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    settings = {"sample_chunks": sample_chunks, "sample_points": sample_points, "cell": cell}
+    cached = {}
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cached = json.load(f)
+        entry = cached.get(key)
+        if (entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns
+                and entry["settings"] == settings):
+            return entry["profile"]
+
+    with laspy.open(path) as reader:
+        profile = header_profile(reader.header)
+        profile.update(sample_profile(reader, sample_chunks, sample_points, cell))
+
+    if cache_file:
+        cached[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "settings": settings, "profile": profile}
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_path = cache_file + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cached, f, indent=2)
+        os.replace(tmp_path, cache_file)
+    return profile
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Profile a LAS/LAZ file from its header and a small sample.')
+    parser.add_argument('file', help='LAS/LAZ file')
+    parser.add_argument('--json', action='store_true', help='Print the whole profile as JSON')
+
+    args = parser.parse_args()
+    p = point_profile(args.file)
+    if args.json:
+        print(json.dumps(p, indent=2))
+    else:
+        print(f"Points: {p['point_count']:,}")
+        print(f"Header density: {p['density_per_m2']:.2f} pts/m², spacing ≈ {p['spacing_m']:.2f} m")
+        if p["occupied_density_per_m2"]:
+            print(f"Occupied density: {p['occupied_density_per_m2']:.2f} pts/m², "
+                  f"spacing ≈ {p['occupied_spacing_m']:.2f} m")
+        print(f"Dimensions: {', '.join(p['dimensions'])}")
+        print(f"Classes (estimated): {p['class_counts']}")
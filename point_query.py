@@ -0,0 +1,140 @@
+# imports
+import os
+import json
+import hashlib
+from typing import List, Tuple
+
+import numpy as np
+import laspy
+import shapely
+
+CHUNK_INDEX_DIR = os.path.join("output", "cache", "chunk_index")
+INDEX_CHUNK = 50_000  # points per indexed run - PDAL's LAZ chunk size, so a run is one LAZ chunk
+XY_SELECTION = laspy.DecompressionSelection.XY_RETURNS_CHANNEL
+
+
+def is_copc(path: str) -> bool:
+    return path.lower().endswith(".copc.laz")
+
+
+def build_chunk_index(path: str, chunk_points: int = INDEX_CHUNK) -> np.ndarray:
+    """
+    XY bounds of each run of chunk_points consecutive points in a LAS/LAZ file.
+    Returns rows of (start, count, min_x, min_y, max_x, max_y). Only X and Y are decompressed.
+    """
+    rows = []
+    start = 0
+    with laspy.open(path, decompression_selection=XY_SELECTION) as reader:
+        for points in reader.chunk_iterator(chunk_points):
+            x, y = np.asarray(points.x), np.asarray(points.y)
+            rows.append([start, len(points), x.min(), y.min(), x.max(), y.max()])
+            start += len(points)
+    return np.array(rows, dtype=np.float64).reshape(-1, 6)
+
+
+def chunk_index(path: str, chunk_points: int = INDEX_CHUNK, cache_dir: str = CHUNK_INDEX_DIR) -> np.ndarray:
+    """
+    Chunk index of a LAS/LAZ file (see build_chunk_index), built on the first query and
+    cached per file keyed by size and mtime. The merged surveys are written tile by
+    tile, so each chunk covers a small patch and a query only touches the chunks of
+    the tiles it overlaps.
+    """
+    stat = os.stat(path)
+    key = {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+           "chunk_points": chunk_points}
+    cache_file = None
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, hashlib.md5(key["path"].encode()).hexdigest() + ".json")
+        if os.path.exists(cache_file):
+            with open(cache_file) as f:
+                cached = json.load(f)
+            if cached["key"] == key:
+                return np.array(cached["chunks"], dtype=np.float64).reshape(-1, 6)
+
+    index = build_chunk_index(path, chunk_points)
+
+    if cache_file:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = cache_file + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"key": key, "chunks": index.tolist()}, f)
+        os.replace(tmp_path, cache_file)
+    return index
+
+
+def query_bounds(bounds=None, polygon=None):
+    """
+    The (min_x, min_y, max_x, max_y) box to read - bounds, the polygon's bounds, or
+    their intersection when both are given. None when neither is given.
+    """
+    if polygon is None:
+        return None if bounds is None else tuple(float(b) for b in bounds)
+    box = polygon.bounds
+    if bounds is not None:
+        box = (max(box[0], bounds[0]), max(box[1], bounds[1]), min(box[2], bounds[2]), min(box[3], bounds[3]))
+    return tuple(float(b) for b in box)
+
+
+def overlapping_runs(index: np.ndarray, box) -> List[Tuple[int, int]]:
+    """(start, count) of the runs of consecutive indexed chunks whose bounds overlap box."""
+    min_x, min_y, max_x, max_y = box
+    hit = (index[:, 2] <= max_x) & (index[:, 4] >= min_x) & (index[:, 3] <= max_y) & (index[:, 5] >= min_y)
+    runs = []
+    for start, count in index[hit, :2].astype(np.int64):
+        if runs and runs[-1][0] + runs[-1][1] == start:
+            runs[-1] = (runs[-1][0], runs[-1][1] + int(count))
+        else:
+            runs.append((int(start), int(count)))
+    return runs
+
+
+def read_candidates(path: str, box, chunk_size: int, selection):
+    """
+    Yield the points of the chunks (LAS/LAZ) or octree nodes (COPC) that overlap box.
+    These still include points outside it - iter_points does the exact filter.
+    """
+    if is_copc(path):
+        with laspy.CopcReader.open(path, decompression_selection=selection) as reader:
+            yield reader.query(bounds=laspy.copc.Bounds(mins=np.array(box[:2]), maxs=np.array(box[2:])))
+        return
+    runs = overlapping_runs(chunk_index(path), box)
+    with laspy.open(path, decompression_selection=selection) as reader:
+        for start, count in runs:
+            # LAZ seeks via the chunk table, so only the chunks in the run are decompressed
+            reader.seek(start)
+            while count > 0:
+                points = reader.read_points(min(count, chunk_size))
+                if len(points) == 0:
+                    break
+                count -= len(points)
+                yield points
+
+
+def iter_points(path: str, bounds=None, polygon=None, chunk_size: int = 1_000_000,
+                selection=laspy.DecompressionSelection.all()):
+    """
+    Stream the points of a LAS/LAZ/COPC file in chunks, optionally only those within
+    bounds (min_x, min_y, max_x, max_y) and/or inside a shapely polygon (same CRS).
+
+    With no bounds or polygon the whole file is read. Otherwise only the COPC octree
+    nodes or the indexed LAZ chunks overlapping the query are read, then each point
+    is tested exactly against the box and polygon, so a query costs time in
+    proportion to its area rather than to the whole survey. selection limits the
+    dimensions decompressed (LAZ 1.4 files).
+    """
+    box = query_bounds(bounds, polygon)
+    if box is None:
+        with laspy.open(path, decompression_selection=selection) as reader:
+            yield from reader.chunk_iterator(chunk_size)
+        return
+    if box[0] > box[2] or box[1] > box[3]:
+        return  # bounds and polygon don't overlap
+    if polygon is not None:
+        shapely.prepare(polygon)
+    for points in read_candidates(path, box, chunk_size, selection):
+        x, y = np.asarray(points.x), np.asarray(points.y)
+        inside = (x >= box[0]) & (x <= box[2]) & (y >= box[1]) & (y <= box[3])
+        if polygon is not None and inside.any():
+            inside[inside] = shapely.contains_xy(polygon, x[inside], y[inside])
+        if inside.any():
+            yield points[inside]
@@ -0,0 +1,159 @@
+# imports
+import time
+from typing import Dict, List
+
+import numpy as np
+import polars as pl
+import laspy
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+from height_hist import HeightHistogram
+from point_query import iter_points
+from spatial_lib import HAG_SELECTION
+from zonal import (grid_key, rasterize_labels, LABEL_CACHE_DIR, MEMORY_BUDGET_MB, BYTES_PER_PIXEL, WOODY_HEIGHT,
+                   SHAPE_COLUMNS)
+
+LABEL_CELL = 0.25  # metres - label grid cell, points take the label of the cell they fall in
+STEM_GRID = 2.0  # metres - stem proxy grid (see spatial_lib.grid_cell_stem_proxy)
+STEM_HEIGHT = 2.0  # metres - stem proxy height cutoff
+POINT_STATS_VERSION = 1  # Bump when the stats change - stored as metric_version in metrics_store.py
+
+
+def point_label_grid(shapes, cell: float = LABEL_CELL, cache_dir: str = LABEL_CACHE_DIR, memory_mb: float = None):
+    """
+    Rasterise the polygons onto a cell x cell grid over their own bounds, for looking
+    up the polygon of each point. Labels follow zonal.label_grid (i + 1 is
+    shapes.iloc[i], 0 is outside). The grid only depends on the polygons, so one
+    cached grid serves every survey date. Returns the memory-mapped labels and the
+    grid's transform.
+    """
+    min_x, min_y, max_x, max_y = shapes.total_bounds
+    left, bottom = np.floor(min_x / cell) * cell, np.floor(min_y / cell) * cell
+    width = max(int(np.ceil((max_x - left) / cell)), 1)
+    height = max(int(np.ceil((max_y - bottom) / cell)), 1)
+    transform = from_origin(left, bottom + height * cell, cell, cell)
+    rows = max(int((memory_mb or MEMORY_BUDGET_MB) * 1024 ** 2 // (width * BYTES_PER_PIXEL)), 1)
+    strips = [Window(0, row, width, min(rows, height - row)) for row in range(0, height, rows)]
+    key = grid_key(shapes, shapes.crs, transform, width, height)
+    return rasterize_labels(shapes, transform, width, height, key, strips, cache_dir), transform
+
+
+def point_zonal_stats(las_path: str, shapes, qs: List[float] = (50, 90), cell: float = LABEL_CELL,
+                      grid: float = STEM_GRID, height_cutoff: float = STEM_HEIGHT, chunk_size: int = 1_000_000,
+                      memory_mb: float = None) -> Dict[str, np.ndarray]:
+    """
+    Point cloud metrics of every polygon from one streamed pass over a LAS/LAZ file
+    with HeightAboveGround. Each chunk's points are labelled with their polygon by
+    indexing the label grid (no per-point geometry tests) and accumulated per polygon:
+
+      • count and density - all points, per m² of polygon
+      • mean and percentiles of HeightAboveGround - points above 0 m, as for the CHM,
+        from a HeightHistogram so they are within HIST_BIN / 2 of exact
+      • cover - share of first returns above WOODY_HEIGHT
+      • stem proxy - occupied grid x grid cells with points above height_cutoff, each
+        cell counted for the polygon holding its centre, per ha of polygon
+
+    Only the chunks overlapping the polygons are read (see point_query.iter_points).
+    Returns arrays indexed like shapes, plus the polygons' HeightHistogram.
+    """
+    qs = list(qs)
+    with laspy.open(las_path) as reader:
+        if 'HeightAboveGround' not in reader.header.point_format.dimension_names:
+            raise RuntimeError("LAS file missing HeightAboveGround dimension")   # PDAL writes this extra dim
+    labels, transform = point_label_grid(shapes, cell, memory_mb=memory_mb)
+    label_rows, label_cols = labels.shape
+    left, top = transform.c, transform.f
+    n = len(shapes)
+
+    counts = np.zeros(n, dtype=np.int64)
+    above = np.zeros(n, dtype=np.int64)
+    sums = np.zeros(n)
+    first = np.zeros(n, dtype=np.int64)
+    first_woody = np.zeros(n, dtype=np.int64)
+    hist = HeightHistogram(n)
+    stem_rows = int(np.ceil(label_rows * cell / grid))
+    stem_cols = int(np.ceil(label_cols * cell / grid))
+    occupied = np.zeros(stem_rows * stem_cols, dtype=bool)
+
+    for points in iter_points(las_path, bounds=shapes.total_bounds, chunk_size=chunk_size, selection=HAG_SELECTION):
+        x, y = np.asarray(points.x), np.asarray(points.y)
+        hag = np.asarray(points['HeightAboveGround'], dtype=np.float64)
+
+        # stem cells are occupied by any tall point, the polygon is assigned below
+        tall = hag > height_cutoff
+        stem_col = np.floor((x[tall] - left) / grid).astype(np.int64)
+        stem_row = np.floor((top - y[tall]) / grid).astype(np.int64)
+        on_grid = (stem_col >= 0) & (stem_col < stem_cols) & (stem_row >= 0) & (stem_row < stem_rows)
+        occupied[stem_row[on_grid] * stem_cols + stem_col[on_grid]] = True
+
+        col = np.floor((x - left) / cell).astype(np.int64)
+        row = np.floor((top - y) / cell).astype(np.int64)
+        inside = (col >= 0) & (col < label_cols) & (row >= 0) & (row < label_rows)
+        ids = np.zeros(len(x), dtype=np.int64)
+        ids[inside] = labels[row[inside], col[inside]]
+        keep = ids > 0
+        if not keep.any():
+            continue
+        ids, hag = ids[keep] - 1, hag[keep]
+        is_first = np.asarray(points.return_number)[keep] == 1
+
+        counts += np.bincount(ids, minlength=n)
+        positive = hag > 0
+        above += np.bincount(ids[positive], minlength=n)
+        sums += np.bincount(ids[positive], weights=hag[positive], minlength=n)
+        hist.add(hag[positive], ids[positive])
+        first += np.bincount(ids[is_first], minlength=n)
+        first_woody += np.bincount(ids[is_first & (hag > WOODY_HEIGHT)], minlength=n)
+
+    # the polygon of each occupied stem cell, by the label under its centre
+    cells = np.nonzero(occupied)[0]
+    centre_row = ((cells // stem_cols + 0.5) * grid / cell).astype(np.int64)
+    centre_col = ((cells % stem_cols + 0.5) * grid / cell).astype(np.int64)
+    on_labels = (centre_row < label_rows) & (centre_col < label_cols)
+    cell_ids = np.asarray(labels[centre_row[on_labels], centre_col[on_labels]]).astype(np.int64)
+    stems = np.bincount(cell_ids[cell_ids > 0] - 1, minlength=n)
+
+    area_m2 = shapes.geometry.area.to_numpy()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        stats = {
+            "point_count": counts,
+            "point_density_per_m2": counts / area_m2,
+            "mean_hag_m": sums / above,
+            "cover_fraction": first_woody / first,
+            "stems_per_ha": stems / (area_m2 / 10_000),
+            "histogram": hist,
+        }
+    for q, percentile in zip(qs, hist.quantile(qs)):
+        stats[f"p{q:g}_hag_m"] = percentile
+    return stats
+
+
+def point_stats(date: str, las_path: str, shapes) -> pl.DataFrame:
+    """
+    Point cloud stats of every polygon with points for one date, in the
+    rehab_chm_stats.parquet layout (the date is left as the folder name string).
+    """
+    stats = point_zonal_stats(las_path, shapes)
+    has = stats["point_count"] > 0
+    table = {"date": [date] * int(has.sum())}
+    for column in SHAPE_COLUMNS:
+        table[column] = shapes[column].to_numpy()[has].tolist()
+    for column in ["point_count", "point_density_per_m2", "mean_hag_m", "p50_hag_m", "p90_hag_m",
+                   "cover_fraction", "stems_per_ha"]:
+        table[column] = stats[column][has]
+    return pl.DataFrame(table)
+
+
+def point_stats_by_date(las_by_date: Dict[str, str], shapes) -> pl.DataFrame:
+    """Point cloud stats of every polygon for every date - one pass over each date's survey."""
+    frames = []
+    for date, las_path in las_by_date.items():
+        print(f"Processing {date}: {las_path}")
+        start_time = time.time()
+        frames.append(point_stats(date, las_path, shapes))
+        print(f"  {frames[-1].height} polygons in {time.time() - start_time:.1f}s")
+    if not frames:
+        return pl.DataFrame()
+    df = pl.concat(frames, how="vertical_relaxed")
+    return df.with_columns(pl.col("date").str.to_date("%Y-%m-%d"))
@@ -2,10 +2,16 @@ import pdal
 import json
 import os
 import time
+import re
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from enum import Enum
 from typing import List, Tuple, Dict, Any
 from spatial_lib import run_pipe_with_time
+from rebuild_cache import BuildManifest, config_values, pipeline_inputs
+from tile_index import TileIndex
+from xyz_ingest import convert_xyz_files, XYZ_CACHE_DIR
+from autotune import load_settings
 
 
 # Configuration section - edit these settings as needed
@@ -27,7 +33,10 @@ class Config:
     OUTPUT_DIR = None  # If None, will use "output/processed/<input_dir_basename>"
     OUTPUT_FILENAME = "lidar_combined.laz"  # Final filename (always fixed now)
     
-    # Spatial filtering (only used in separated mode)
+    # Spatial filtering - tiles are selected by their real bounds from the tile index
+    # min/max are the bottom left corners of the included step x step tiles
+    # excluded_prefix lists the x_y corners of tiles to leave out
+    # polygon_file optionally limits the tiles to those touching its polygons
     # Set to None to disable spatial filtering
     SPATIAL_FILTER = {
         "min_x": 295000,
@@ -35,54 +44,164 @@ class Config:
         "min_y": 6425000,
         "max_y": 6428000,
         "step": 1000,
-        "excluded_prefix": ['297000_6425000']
+        "excluded_prefix": ['297000_6425000'],
+        "polygon_file": None,
     }
     
     # PDAL processing options
     STREAMING = True  # Use streaming mode for PDAL processing
     CHUNK_SIZE = 10000  # Chunk size for streaming mode
+    AUTOTUNE = True  # Use the CHUNK_SIZE (and PARALLEL if 'auto') persisted by autotune.py for this machine
+    
+    # Tile-parallel processing
+    # Set PARALLEL to the number of worker processes to run one pipeline per 1km tile
+    # 0 or 1 runs a single pipeline over all files on one core
+    # 'auto' uses the worker count tuned by autotune.py (a single pipeline if not tuned)
+    PARALLEL = 0
+    TILE_DIR = "tiles"  # Subfolder of the output directory for the per-tile outputs
+    MERGE_TILES = True  # Merge the tiles into OUTPUT_FILENAME, otherwise write TILE_MANIFEST only
+    TILE_MANIFEST = "tiles.json"  # Lists the per-tile outputs, written next to the final output
+    
+    # COPC output - the final pipeline (the merge when tiling) also writes <name>.copc.laz
+    # next to OUTPUT_FILENAME in the same pass, so there is no QGIS step or second read.
+    # writers.copc builds the octree nodes on COPC_THREADS threads. It isn't streamable,
+    # so the final pipeline runs in standard mode (all points in memory) when this is on
+    # When tiling it needs MERGE_TILES, as the merge is what writes it
+    COPC = False
+    COPC_THREADS = os.cpu_count() or 1
+    
+    # Tiled HAG (separated mode) - compute HeightAboveGround one tile at a time
+    # Each tile also reads the ground points within HAG_BUFFER metres from its
+    # neighbouring tiles, so there are no seams at the tile edges
+    # The HAG_BUFFER strips along each side of every ground file are cut once in a
+    # streamed pre-pass, and a tile reads the 8 strips facing it instead of its
+    # neighbours' whole ground files. filters.hag_nn isn't streamable, so a tile holds
+    # its own points plus those strips in memory, and the final merge stays streamable
+    # With False the whole survey is loaded at once
+    # Always used in parallel separated mode
+    TILED_HAG = True
+    TILE_SIZE = 1000  # Tile grid size in metres (tiles are bottom left indexed)
+    HAG_BUFFER = 30  # Ground buffer in metres, must be less than TILE_SIZE
+    EDGE_DIR = "edges"  # Subfolder of TILE_DIR for the ground edge strips
+    
+    # XYZ inputs are converted once to LAZ (with their classification and EPSG:7856)
+    # and later runs read the cached LAZ instead of parsing the text again
+    XYZ_CACHE = True
+    XYZ_CACHE_DIR = XYZ_CACHE_DIR
+    
+    # Run telemetry - one JSON record per pipeline run (None to disable)
+    TELEMETRY_FILE = os.path.join("output", "telemetry", "pipeline_runs.jsonl")
+    
+    # Incremental rebuilds - a manifest next to the outputs records the inputs, pipeline
+    # and config each output was built from, and unchanged outputs are skipped on rerun
+    INCREMENTAL = True
+    HASH_INPUTS = True  # Fingerprint inputs by content hash (False: size and mtime only)
+    FORCE_REBUILD = False  # Rebuild everything and start a fresh manifest
     
     # Classification values
     GROUND_CLASS = 2
     NON_GROUND_CLASS = 4
 
 
+# Settings that change how a run executes but not what it writes - left out of the cache keys
+RUNTIME_SETTINGS = ["MODE", "INPUT_DIR", "OUTPUT_DIR", "STREAMING", "CHUNK_SIZE", "PARALLEL", "INCREMENTAL", "FORCE_REBUILD",
+                    "TELEMETRY_FILE", "AUTOTUNE", "COPC_THREADS"]
+
+
 class ProcessingMode(Enum):
     AUTO = 'auto'
     SINGLE = 'single'
     SEPARATED = 'separated'
 
 
-def get_file_list(directory: str, extensions: List[str], prefixes: List[str] = None) -> List[str]:
-    """Get list of files with specific extensions and optional prefixes."""
-    files = []
-    for f in os.listdir(directory):
-        # Check if file has one of the specified extensions
-        if any(f.lower().endswith(ext.lower()) for ext in extensions):
-            # Check prefixes if specified
-            if prefixes is None or any(f.startswith(prefix) for prefix in prefixes):
-                file_path = os.path.join(directory, f)
-                files.append(file_path)
-    return files
+def select_files(index: TileIndex, directory: str, config) -> List[str]:
+    """
+    Select the files in a directory to process, using the tile index and the spatial
+    filter configuration. Files are selected by their real bounds, not their filenames.
+    """
+    files = index.files_in(directory)
+    if config.SPATIAL_FILTER is None:
+        return files
+    
+    sf = config.SPATIAL_FILTER
+    # min/max are the bottom left corners of the tiles to include
+    selected = set(index.query_bbox(sf["min_x"], sf["min_y"], sf["max_x"] + sf["step"], sf["max_y"] + sf["step"]))
+    if sf.get("polygon_file"):
+        selected &= set(index.query_shapefile(sf["polygon_file"]))
+    excluded = set(sf["excluded_prefix"] or [])
+    return [f for f in files if f in selected and index.tile_of(f, sf["step"]) not in excluded]
 
 
-def generate_spatial_prefixes(config) -> List[str]:
-    """Generate file prefixes based on spatial filtering configuration."""
-    if config.SPATIAL_FILTER is None:
+def group_files_by_tile(files: List[str], index: TileIndex, tile_size: int) -> Dict[str, List[str]]:
+    """Group files by the x_y key of the tile their bounds fall in."""
+    tiles = {}
+    for file_path in files:
+        tiles.setdefault(index.tile_of(file_path, tile_size), []).append(file_path)
+    return tiles
+
+
+def apply_tuned_settings(sample_file: str):
+    """
+    Pick up the settings autotune.py persisted for this machine and the input's dataset profile.
+    The tuned worker count is only used with PARALLEL = 'auto' - it switches the run to
+    per-tile pipelines, so it is never applied unasked.
+    """
+    settings = load_settings(sample_file) if Config.AUTOTUNE else None
+    if Config.PARALLEL == "auto":
+        Config.PARALLEL = settings["parallel"] if settings is not None else 0
+        print(f"Using PARALLEL={Config.PARALLEL}" + (" (tuned)" if settings is not None else " - not tuned yet"))
+    if settings is None:
+        return
+    Config.CHUNK_SIZE = settings["chunk_size"]
+    print(f"Using tuned settings: CHUNK_SIZE={Config.CHUNK_SIZE}")
+
+
+def parallel_workers(value: str):
+    """Parse --parallel: a worker count or 'auto'."""
+    return value if value == "auto" else int(value)
+
+
+def cached_xyz(files: List[str], laz_files: Dict[str, str]) -> List[str]:
+    """Swap XYZ files for their cached LAZ conversions."""
+    return [laz_files.get(f, f) for f in files]
+
+
+def get_tile_bounds(tile: str, tile_size: int) -> Tuple[float, float, float, float]:
+    """Get the (min_x, min_y, max_x, max_y) extent of a tile from its x_y key."""
+    match = re.fullmatch(r"(\d+)_(\d+)", tile)
+    if not match:
         return None
-        
-    sf = config.SPATIAL_FILTER
-    included_prefixes = []
-    
-    for x in range(sf["min_x"], sf["max_x"] + sf["step"], sf["step"]):
-        for y in range(sf["min_y"], sf["max_y"] + sf["step"], sf["step"]):
-            # Skip excluded prefixes
-            if sf["excluded_prefix"] and f"{x}_{y}" in sf["excluded_prefix"]:
-                continue
-            included_prefix = f"{x}_{y}"
-            included_prefixes.append(included_prefix)
-            
-    return included_prefixes
+    x, y = int(match.group(1)), int(match.group(2))
+    return (x, y, x + tile_size, y + tile_size)
+
+
+def get_neighbour_tiles(tile: str, tile_size: int) -> List[str]:
+    """Get the x_y keys of the 8 tiles surrounding a tile."""
+    bounds = get_tile_bounds(tile, tile_size)
+    if bounds is None:
+        return []
+    x, y = bounds[0], bounds[1]
+    return [
+        f"{x + dx * tile_size}_{y + dy * tile_size}"
+        for dx in (-1, 0, 1)
+        for dy in (-1, 0, 1)
+        if (dx, dy) != (0, 0)
+    ]
+
+
+def facing_side(tile: str, neighbour: str, tile_size: int) -> str:
+    """The side of a neighbouring tile that faces the tile - the diagonal neighbours use their east or west side."""
+    tile_x, tile_y = get_tile_bounds(tile, tile_size)[:2]
+    neighbour_x, neighbour_y = get_tile_bounds(neighbour, tile_size)[:2]
+    if neighbour_x != tile_x:
+        return "east" if neighbour_x < tile_x else "west"
+    return "north" if neighbour_y < tile_y else "south"
+
+
+def edge_strip_file(edge_dir: str, ground_file: str, side: str) -> str:
+    """Output file of one side's edge strip of a ground file."""
+    name = os.path.splitext(os.path.basename(ground_file))[0]
+    return os.path.join(edge_dir, f"{name}_{side}.laz")
 
 
 def detect_processing_mode(config) -> ProcessingMode:
@@ -112,8 +231,8 @@ def generate_tag(prefix, index):
     return f"{prefix}_{index+1}"
 
 
-def generate_single_pipeline(input_files: List[str], output_file: str) -> Dict[str, Any]:
-    """Generate a PDAL pipeline for merging multiple files from a single directory."""
+def generate_single_pipeline(input_files: List[str], output_file: str, copc_file: str = None) -> Dict[str, Any]:
+    """Generate a PDAL pipeline for merging multiple files from a single directory, optionally also writing COPC."""
     pipeline = []
     
     # Add all files as readers
@@ -143,12 +262,15 @@ def generate_single_pipeline(input_files: List[str], output_file: str) -> Dict[s
         "filename": output_file,
         "compression": "laszip"
     })
+    if copc_file:
+        pipeline.append(generate_copc_writer(copc_file))
     
     return {"pipeline": pipeline}
 
 
-def generate_separated_pipeline(ground_files: List[str], non_ground_files: List[str], output_file: str) -> Dict[str, Any]:
-    """Generate a PDAL pipeline for merging ground and non-ground files."""
+def generate_separated_pipeline(ground_files: List[str], non_ground_files: List[str], output_file: str,
+                                copc_file: str = None) -> Dict[str, Any]:
+    """Generate a PDAL pipeline for merging ground and non-ground files, optionally also writing COPC."""
     pipeline = []
     input_tags = []
     
@@ -227,10 +349,315 @@ def generate_separated_pipeline(ground_files: List[str], non_ground_files: List[
         "compression": "laszip",
         "extra_dims": "HeightAboveGround=float32" 
     })
+    if copc_file:
+        pipeline.append(generate_copc_writer(copc_file))
+
+    return {"pipeline": pipeline}
+
+
+def generate_reader(file_path: str, classification: int = None, tag: str = None) -> List[Dict[str, Any]]:
+    """
+    Generate the reader stages for one file, assigning its classification.
+    XYZ files always need a classification, LAS/LAZ files keep their own if classification is None.
+    The tag (if any) is put on the last stage.
+    """
+    if is_xyz_file(file_path):
+        stages = [
+            {
+                "type": "readers.text",
+                "filename": file_path,
+                "spatialreference": "EPSG:7856",
+                "header": "X Y Z",
+            },
+            {
+                "type": "filters.assign",
+                "value": f"Classification={classification}",
+            }
+        ]
+    else:
+        stages = [
+            {
+                "type": "readers.las",
+                "filename": file_path,
+            }
+        ]
+        if classification is not None:
+            stages.append({
+                "type": "filters.assign",
+                "assignment": f"Classification[:]={classification}",
+            })
+    if tag:
+        stages[-1]["tag"] = tag
+    return stages
+
+
+def generate_edge_strip_pipeline(tile_bounds: Tuple[float, float, float, float], ground_file: str, side: str,
+                                 output_file: str, buffer: float) -> Dict[str, Any]:
+    """
+    Generate a streamable PDAL pipeline writing the edge strip of one ground file on one
+    side of its tile - the points within buffer metres of that side, and any beyond it.
+    The neighbouring tile on that side reads the strip instead of the whole file.
+    """
+    min_x, min_y, max_x, max_y = tile_bounds
+    limits = {
+        "west": f"X[:{min_x + buffer}]",
+        "east": f"X[{max_x - buffer}:]",
+        "south": f"Y[:{min_y + buffer}]",
+        "north": f"Y[{max_y - buffer}:]",
+    }[side]
+    pipeline = generate_reader(ground_file, Config.GROUND_CLASS if is_xyz_file(ground_file) else None)
+    pipeline.append({
+        "type": "filters.range",
+        "limits": limits
+    })
+    pipeline.append({
+        "type": "writers.las",
+        "filename": output_file,
+        "compression": "laszip"
+    })
+    return {"pipeline": pipeline}
+
+
+def generate_tiled_hag_pipeline(tile_bounds: Tuple[float, float, float, float], ground_files: List[str],
+                                non_ground_files: List[str], buffer_files: List[str], output_file: str,
+                                buffer: float) -> Dict[str, Any]:
+    """
+    Generate a PDAL pipeline computing HAG for one tile.
+    ground_files and non_ground_files are the tile's own files and are written in full.
+    buffer_files are the edge strips of the neighbouring tiles' ground files (see
+    generate_edge_strip_pipeline) - they are cropped to the tile extent plus the buffer,
+    used as ground for hag_nn and then dropped before writing.
+    """
+    pipeline = []
+    input_tags = []
+    
+    for i, ng_file in enumerate(non_ground_files):
+        tag = generate_tag("ng", i)
+        pipeline.extend(generate_reader(ng_file, Config.NON_GROUND_CLASS, tag))
+        input_tags.append(tag)
+    
+    for i, g_file in enumerate(ground_files):
+        tag = generate_tag("g", i)
+        pipeline.extend(generate_reader(g_file, Config.GROUND_CLASS if is_xyz_file(g_file) else None, tag))
+        input_tags.append(tag)
+    
+    # Neighbouring ground points within the buffer, flagged so they can be removed after HAG
+    if buffer_files:
+        min_x, min_y, max_x, max_y = tile_bounds
+        buffer_bounds = f"([{min_x - buffer},{max_x + buffer}],[{min_y - buffer},{max_y + buffer}])"
+    for i, b_file in enumerate(buffer_files):
+        tag = generate_tag("b", i)
+        pipeline.extend(generate_reader(b_file, Config.GROUND_CLASS if is_xyz_file(b_file) else None))
+        pipeline.append({
+            "type": "filters.crop",
+            "bounds": buffer_bounds
+        })
+        pipeline.append({
+            "type": "filters.ferry",
+            "dimensions": "=>HagBuffer"
+        })
+        pipeline.append({
+            "type": "filters.assign",
+            "value": "HagBuffer=1",
+            "tag": tag
+        })
+        input_tags.append(tag)
+    
+    pipeline.append({
+        "type": "filters.merge",
+        "inputs": input_tags
+    })
+    
+    pipeline.append({
+        "type": "filters.hag_nn"
+    })
+    
+    # Drop the buffer points - only the tile's own points are written
+    if buffer_files:
+        pipeline.append({
+            "type": "filters.range",
+            "limits": "HagBuffer[0:0]"
+        })
+    
+    pipeline.append({
+        "type": "writers.las",
+        "filename": output_file,
+        "compression": "laszip",
+        "extra_dims": "HeightAboveGround=float32"
+    })
+    
+    return {"pipeline": pipeline}
+
 
+def generate_copc_writer(copc_file: str) -> Dict[str, Any]:
+    """
+    writers.copc stage for the end of a pipeline, after its writers.las - both writers
+    take the same points, so the LAZ and the COPC come from one read of the inputs.
+    """
+    return {
+        "type": "writers.copc",
+        "filename": copc_file,
+        "threads": Config.COPC_THREADS,
+        "extra_dims": "all"
+    }
+
+
+def copc_filename(output_file: str) -> str:
+    """lidar_combined.laz -> lidar_combined.copc.laz"""
+    return os.path.splitext(output_file)[0] + ".copc.laz"
+
+
+def generate_merge_pipeline(tile_files: List[str], output_file: str, copc_file: str = None) -> Dict[str, Any]:
+    """Generate a PDAL pipeline for merging the per-tile outputs into one file, optionally also writing COPC."""
+    pipeline = []
+    
+    for file_path in tile_files:
+        pipeline.append({
+            "type": "readers.las",
+            "filename": file_path
+        })
+    
+    if len(tile_files) > 1:
+        pipeline.append({
+            "type": "filters.merge"
+        })
+    
+    # Keep any extra dims written by the tile pipelines (e.g. HeightAboveGround)
+    pipeline.append({
+        "type": "writers.las",
+        "filename": output_file,
+        "compression": "laszip",
+        "extra_dims": "all"
+    })
+    if copc_file:
+        pipeline.append(generate_copc_writer(copc_file))
+    
     return {"pipeline": pipeline}
 
 
+def telemetry_tags() -> Dict[str, Any]:
+    """Extra fields for the telemetry records of this run."""
+    return {"dataset": os.path.basename(os.path.normpath(Config.INPUT_DIR))}
+
+
+def run_tile_pipeline(tile: str, pipeline_json: Dict[str, Any], streaming: bool, chunk_size: int,
+                      telemetry: str = None, tags: Dict[str, Any] = None, stage: str = "tile") -> str:
+    """Run the pipeline for one tile (or edge strip). Executed in a worker process."""
+    p = pdal.Pipeline(json.dumps(pipeline_json))
+    run_pipe_with_time(p, streaming=streaming, chunk_size=chunk_size, telemetry=telemetry,
+                       stage=f"{stage} {tile}", tags=tags)
+    return tile
+
+
+def run_cached_pipeline(pipeline_json: Dict[str, Any], output_file: str, manifest: BuildManifest, stage: str = None,
+                        extra_outputs: List[str] = ()):
+    """
+    Run a pipeline unless its output is up to date in the manifest, then record the new output.
+    extra_outputs are other files the pipeline writes (e.g. the COPC) - it is rerun if any is missing.
+    """
+    if manifest is None:
+        p = pdal.Pipeline(json.dumps(pipeline_json))
+        run_pipe_with_time(p, streaming=Config.STREAMING, chunk_size=Config.CHUNK_SIZE,
+                           telemetry=Config.TELEMETRY_FILE, stage=stage, tags=telemetry_tags())
+        return
+    
+    config = config_values(Config, exclude=RUNTIME_SETTINGS)
+    fingerprints = manifest.fingerprints(pipeline_inputs(pipeline_json))
+    key = manifest.cache_key(pipeline_json, fingerprints, config)
+    outputs = [output_file, *extra_outputs]
+    if all(manifest.is_up_to_date(output, key) for output in outputs):
+        print(f"{output_file} is up to date - skipping")
+        return
+    
+    p = pdal.Pipeline(json.dumps(pipeline_json))
+    run_pipe_with_time(p, streaming=Config.STREAMING, chunk_size=Config.CHUNK_SIZE,
+                       telemetry=Config.TELEMETRY_FILE, stage=stage, tags=telemetry_tags())
+    for output in outputs:
+        manifest.record(output, key, pipeline_json, fingerprints, config)
+
+
+def run_jobs_parallel(tile_jobs: Dict[str, Tuple[Dict[str, Any], str]], manifest: BuildManifest = None,
+                      streaming: bool = False, stage: str = "tile") -> Dict[str, str]:
+    """
+    Run per-tile pipelines in a process pool. tile_jobs maps the tile key to its
+    (pipeline, tile output file). Tiles that are up to date in the build manifest are
+    not rerun. Returns the output file of every tile that is up to date or succeeded.
+    """
+    tile_outputs = {}
+    pending = {}
+    config = config_values(Config, exclude=RUNTIME_SETTINGS)
+    for tile, (pipeline_json, tile_output) in tile_jobs.items():
+        if manifest is None:
+            pending[tile] = None
+            continue
+        fingerprints = manifest.fingerprints(pipeline_inputs(pipeline_json))
+        key = manifest.cache_key(pipeline_json, fingerprints, config)
+        if manifest.is_up_to_date(tile_output, key):
+            tile_outputs[tile] = tile_output
+        else:
+            pending[tile] = (key, fingerprints)
+    if tile_outputs:
+        print(f"{len(tile_outputs)} tiles are up to date - skipping them")
+    
+    if pending:
+        workers = max(1, min(Config.PARALLEL, len(pending)))
+        print(f"Processing {len(pending)} tiles with {workers} worker processes")
+        start_time = time.time()
+        
+        # peak RSS is per process lifetime, so with telemetry each tile gets a fresh worker
+        # and its record doesn't report the largest tile the worker ran before it
+        pool_options = {"max_tasks_per_child": 1} if Config.TELEMETRY_FILE else {}
+        with ProcessPoolExecutor(max_workers=workers, **pool_options) as executor:
+            futures = {
+                executor.submit(run_tile_pipeline, tile, tile_jobs[tile][0], streaming, Config.CHUNK_SIZE,
+                                Config.TELEMETRY_FILE, telemetry_tags(), stage): tile
+                for tile in pending
+            }
+            for future in as_completed(futures):
+                tile = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"  Error processing {stage} {tile}: {e}")
+                    continue
+                pipeline_json, tile_output = tile_jobs[tile]
+                tile_outputs[tile] = tile_output
+                if manifest is not None:
+                    key, fingerprints = pending[tile]
+                    manifest.record(tile_output, key, pipeline_json, fingerprints, config)
+                print(f"  {stage.capitalize()} {tile} complete ({len(tile_outputs)}/{len(tile_jobs)})")
+        
+        print(f"{stage.capitalize()} processing complete in {time.time() - start_time:.2f} seconds.")
+    return tile_outputs
+
+
+def process_tiles_parallel(tile_jobs: Dict[str, Tuple[Dict[str, Any], str]], output_dir: str, output_filename: str,
+                           manifest: BuildManifest = None, streaming: bool = False):
+    """
+    Run the per-tile pipelines in a process pool, then merge the tile outputs
+    into the final file (or write a manifest of the tiles if MERGE_TILES is off).
+    tile_jobs maps the tile key to its (pipeline, tile output file).
+    streaming is for the tile pipelines - the merge always uses Config.STREAMING.
+    Tiles that are up to date in the build manifest are not rerun.
+    """
+    tile_outputs = run_jobs_parallel(tile_jobs, manifest, streaming)
+    if len(tile_outputs) < len(tile_jobs):
+        print(f"{len(tile_jobs) - len(tile_outputs)} tiles failed - skipping the merge step")
+        return
+    
+    # Write the manifest of the tile outputs
+    manifest_file = os.path.join(output_dir, Config.TILE_MANIFEST)
+    with open(manifest_file, "w") as f:
+        json.dump({"tiles": dict(sorted(tile_outputs.items()))}, f, indent=4)
+    print(f"Tile manifest written to {manifest_file}")
+    
+    if Config.MERGE_TILES:
+        copc_file = copc_filename(output_filename) if Config.COPC else None
+        merge_json = generate_merge_pipeline(sorted(tile_outputs.values()), output_filename, copc_file)
+        run_cached_pipeline(merge_json, output_filename, manifest, stage="merge",
+                            extra_outputs=[copc_file] if copc_file else [])
+
+
 def process_files():
     """Main function to process files based on configuration."""
     # Determine processing mode
@@ -248,23 +675,40 @@ def process_files():
     
     print(f"Output directory: {output_dir}")
     print(f"Output filename: {output_filename}")
+    copc_file = copc_filename(output_filename) if Config.COPC else None
+    if copc_file:
+        print(f"COPC filename: {copc_file}")
     
-    # Generate spatial prefixes if spatial filtering is enabled
-    prefixes = generate_spatial_prefixes(Config)
-    if prefixes:
-        print(f"Using spatial prefixes filter with {len(prefixes)} prefixes")
+    # Per-tile outputs are only used in parallel or tiled HAG mode
+    tile_dir = os.path.join(output_dir, Config.TILE_DIR)
+    tile_jobs = {}
+    # Ground edge strips for tiled HAG, cut before the tiles that read them
+    edge_dir = os.path.join(tile_dir, Config.EDGE_DIR)
+    edge_jobs = {}
     
     # Process based on mode
     if mode == ProcessingMode.SINGLE:
         # Get all LAS/LAZ/XYZ files from the input directory
-        input_files = get_file_list(Config.INPUT_DIR, ['.las', '.laz', '.xyz'], prefixes)
+        index = TileIndex([Config.INPUT_DIR])
+        input_files = select_files(index, Config.INPUT_DIR, Config)
         
         print(f"Found {len(input_files)} input files")
         if not input_files:
             print("No input files found. Check your configuration.")
             return
-            
-        pipeline_json = generate_single_pipeline(input_files, output_filename)
+        
+        apply_tuned_settings(input_files[0])
+        parallel = Config.PARALLEL > 1
+        
+        # XYZ files have no classification in single mode
+        laz_files = convert_xyz_files(input_files, 0, Config.XYZ_CACHE_DIR, Config.PARALLEL) if Config.XYZ_CACHE else {}
+        
+        if parallel:
+            for tile, tile_files in group_files_by_tile(input_files, index, Config.TILE_SIZE).items():
+                tile_output = os.path.join(tile_dir, f"{tile}.laz")
+                tile_jobs[tile] = (generate_single_pipeline(cached_xyz(tile_files, laz_files), tile_output), tile_output)
+        else:
+            pipeline_json = generate_single_pipeline(cached_xyz(input_files, laz_files), output_filename, copc_file)
         
     elif mode == ProcessingMode.SEPARATED:
         # Get paths for ground and non-ground directories
@@ -279,22 +723,91 @@ def process_files():
         print(f"Ground directory: {ground_dir}")
         print(f"Non-ground directory: {non_ground_dir}")
         
-        # Handle LAS or XYZ directories - search for both extensions
-        file_extensions = ['.las', '.laz', '.xyz']
-        ground_files = get_file_list(ground_dir, file_extensions, prefixes)
-        non_ground_files = get_file_list(non_ground_dir, file_extensions, prefixes)
+        # Handle LAS or XYZ directories - the index covers both extensions
+        index = TileIndex([ground_dir, non_ground_dir])
+        ground_files = select_files(index, ground_dir, Config)
+        non_ground_files = select_files(index, non_ground_dir, Config)
         
         print(f"Found {len(ground_files)} ground files and {len(non_ground_files)} non-ground files")
         if not ground_files and not non_ground_files:
             print("No input files found. Check your configuration.")
             return
-            
-        pipeline_json = generate_separated_pipeline(ground_files, non_ground_files, output_filename)
+        
+        apply_tuned_settings((ground_files or non_ground_files)[0])
+        parallel = Config.PARALLEL > 1 or Config.TILED_HAG
+        
+        laz_files = {}
+        if Config.XYZ_CACHE:
+            laz_files.update(convert_xyz_files(ground_files, Config.GROUND_CLASS, Config.XYZ_CACHE_DIR, Config.PARALLEL))
+            laz_files.update(convert_xyz_files(non_ground_files, Config.NON_GROUND_CLASS, Config.XYZ_CACHE_DIR, Config.PARALLEL))
+        
+        if parallel:
+            ground_tiles = {
+                tile: cached_xyz(files, laz_files)
+                for tile, files in group_files_by_tile(ground_files, index, Config.TILE_SIZE).items()
+            }
+            non_ground_tiles = {
+                tile: cached_xyz(files, laz_files)
+                for tile, files in group_files_by_tile(non_ground_files, index, Config.TILE_SIZE).items()
+            }
+            if Config.HAG_BUFFER >= Config.TILE_SIZE:
+                raise ValueError("HAG_BUFFER must be less than TILE_SIZE")
+            for tile in sorted(set(ground_tiles) | set(non_ground_tiles)):
+                tile_bounds = get_tile_bounds(tile, Config.TILE_SIZE)
+                buffer_files = []
+                for neighbour in get_neighbour_tiles(tile, Config.TILE_SIZE):
+                    side = facing_side(tile, neighbour, Config.TILE_SIZE)
+                    for g_file in ground_tiles.get(neighbour, []):
+                        strip = edge_strip_file(edge_dir, g_file, side)
+                        edge_jobs[os.path.splitext(os.path.basename(strip))[0]] = (generate_edge_strip_pipeline(
+                            get_tile_bounds(neighbour, Config.TILE_SIZE), g_file, side, strip, Config.HAG_BUFFER
+                        ), strip)
+                        buffer_files.append(strip)
+                if tile not in ground_tiles and not buffer_files:
+                    # hag_nn needs ground points in or around the tile
+                    print(f"  Warning: no ground files for tile {tile} - skipping")
+                    continue
+                tile_output = os.path.join(tile_dir, f"{tile}.laz")
+                tile_json = generate_tiled_hag_pipeline(
+                    tile_bounds, ground_tiles.get(tile, []), non_ground_tiles.get(tile, []),
+                    buffer_files, tile_output, Config.HAG_BUFFER
+                )
+                tile_jobs[tile] = (tile_json, tile_output)
+        else:
+            if Config.STREAMING:
+                print("Warning: single pass HAG is not streamable - the whole survey will be loaded into memory")
+            pipeline_json = generate_separated_pipeline(
+                cached_xyz(ground_files, laz_files), cached_xyz(non_ground_files, laz_files), output_filename,
+                copc_file
+            )
+    
+    manifest = BuildManifest(output_dir, hash_contents=Config.HASH_INPUTS) if Config.INCREMENTAL else None
+    if manifest is not None and Config.FORCE_REBUILD:
+        manifest.outputs = {}
+    
+    if copc_file:
+        if parallel and not Config.MERGE_TILES:
+            raise ValueError("COPC output is written by the tile merge - it needs MERGE_TILES")
+        print("Warning: writers.copc is not streamable - the final pipeline will load the whole survey into memory")
+    
+    if parallel:
+        os.makedirs(tile_dir, exist_ok=True)
+        if edge_jobs:
+            os.makedirs(edge_dir, exist_ok=True)
+            # each strip pipeline is read -> range -> write, so these stream
+            edge_outputs = run_jobs_parallel(edge_jobs, manifest, streaming=Config.STREAMING, stage="edge strip")
+            if len(edge_outputs) < len(edge_jobs):
+                print(f"{len(edge_jobs) - len(edge_outputs)} edge strips failed - skipping the tiles")
+                return
+        # Separated mode tiles run hag_nn, which needs the whole (buffered) tile in memory
+        tile_streaming = Config.STREAMING and mode == ProcessingMode.SINGLE
+        process_tiles_parallel(tile_jobs, output_dir, output_filename, manifest, streaming=tile_streaming)
+        return
     
     # Execute the pipeline
     print(json.dumps(pipeline_json, indent=4))
-    p = pdal.Pipeline(json.dumps(pipeline_json))
-    run_pipe_with_time(p, streaming=Config.STREAMING, chunk_size=Config.CHUNK_SIZE)
+    run_cached_pipeline(pipeline_json, output_filename, manifest, stage=mode.value,
+                        extra_outputs=[copc_file] if copc_file else [])
 
 
 if __name__ == "__main__":
@@ -305,6 +818,18 @@ if __name__ == "__main__":
     parser.add_argument('--input', help='Input directory', default=Config.INPUT_DIR)
     parser.add_argument('--output', help='Output directory (will be created if it doesn\'t exist)', 
                         default=Config.OUTPUT_DIR)
+    parser.add_argument('--force', action='store_true',
+                        help='Rebuild all outputs, ignoring the incremental build manifest')
+    parser.add_argument('--single-pass-hag', action='store_true',
+                        help='Compute HAG over the whole survey in one in-memory pipeline instead of per tile (separated mode)')
+    parser.add_argument('--hag-buffer', type=float, help='Ground buffer in metres for tiled HAG',
+                        default=Config.HAG_BUFFER)
+    parser.add_argument('--parallel', type=parallel_workers, metavar='N',
+                        help="Process each 1km tile as its own pipeline using N worker processes "
+                             "('auto' for the count tuned by autotune.py)",
+                        default=Config.PARALLEL)
+    parser.add_argument('--copc', action='store_true',
+                        help='Also write a .copc.laz of the final output in the same pass (loads the whole survey into memory)')
     
     args = parser.parse_args()
     
@@ -315,5 +840,14 @@ if __name__ == "__main__":
         Config.INPUT_DIR = args.input
     if args.output:
         Config.OUTPUT_DIR = args.output
+    if args.parallel:
+        Config.PARALLEL = args.parallel
+    if args.single_pass_hag:
+        Config.TILED_HAG = False
+    if args.force:
+        Config.FORCE_REBUILD = True
+    if args.copc:
+        Config.COPC = True
+    Config.HAG_BUFFER = args.hag_buffer
         
     process_files()
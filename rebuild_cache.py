@@ -0,0 +1,114 @@
+# imports
+import hashlib
+import json
+import os
+from typing import Any, Dict, List
+
+MANIFEST_FILENAME = "manifest.json"
+
+
+def hash_file(path: str, block_size: int = 1 << 20) -> str:
+    """Return the sha256 of a file's contents."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def pipeline_inputs(pipeline_json: Dict[str, Any]) -> List[str]:
+    """Get the input filenames of a PDAL pipeline (the filename of every reader stage)."""
+    inputs = []
+    for stage in pipeline_json["pipeline"]:
+        if isinstance(stage, str):
+            # a bare filename is a reader unless it's the last stage
+            if stage is not pipeline_json["pipeline"][-1]:
+                inputs.append(stage)
+        elif stage.get("type", "").startswith("readers.") and "filename" in stage:
+            inputs.append(stage["filename"])
+    return inputs
+
+
+def config_values(config, exclude: List[str] = ()) -> Dict[str, Any]:
+    """Get the settings of a Config class (the upper case attributes), minus any excluded ones."""
+    return {
+        k: v for k, v in vars(config).items()
+        if k.isupper() and k not in exclude
+    }
+
+
+class BuildManifest:
+    """
+    Manifest of the outputs in a directory and what they were built from.
+
+    Each output is recorded with a cache key - the hash of the pipeline JSON, the
+    config values and the fingerprints of its input files. An output is up to date
+    when it exists and the key computed for the next run matches the recorded one.
+
+    With hash_contents the input fingerprints are sha256 hashes of the file contents,
+    which are only recomputed when a file's size or mtime changes. Otherwise the
+    fingerprints are just size and mtime.
+    """
+
+    def __init__(self, output_dir: str, hash_contents: bool = True):
+        self.path = os.path.join(output_dir, MANIFEST_FILENAME)
+        self.hash_contents = hash_contents
+        self.outputs = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.outputs = json.load(f).get("outputs", {})
+
+    def _previous_fingerprint(self, path: str) -> Dict[str, Any]:
+        for entry in self.outputs.values():
+            if path in entry.get("inputs", {}):
+                return entry["inputs"][path]
+        return None
+
+    def fingerprint(self, path: str) -> Dict[str, Any]:
+        """Fingerprint one input file, reusing the recorded hash if the file is unchanged."""
+        stat = os.stat(path)
+        fp = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        if not self.hash_contents:
+            return fp
+        previous = self._previous_fingerprint(path)
+        if previous and previous.get("sha256") and previous["size"] == fp["size"] and previous["mtime_ns"] == fp["mtime_ns"]:
+            fp["sha256"] = previous["sha256"]
+        else:
+            fp["sha256"] = hash_file(path)
+        return fp
+
+    def fingerprints(self, input_files: List[str]) -> Dict[str, Dict[str, Any]]:
+        return {path: self.fingerprint(path) for path in input_files}
+
+    def cache_key(self, pipeline_json: Dict[str, Any], fingerprints: Dict[str, Dict[str, Any]],
+                  config: Dict[str, Any]) -> str:
+        """Hash everything an output depends on into one key."""
+        if self.hash_contents:
+            # content addressed - touching a file doesn't invalidate its outputs
+            inputs = {path: fp["sha256"] for path, fp in fingerprints.items()}
+        else:
+            inputs = fingerprints
+        payload = {"pipeline": pipeline_json, "inputs": inputs, "config": config}
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+    def is_up_to_date(self, output_file: str, key: str) -> bool:
+        entry = self.outputs.get(output_file)
+        return entry is not None and entry["key"] == key and os.path.exists(output_file)
+
+    def record(self, output_file: str, key: str, pipeline_json: Dict[str, Any],
+               fingerprints: Dict[str, Dict[str, Any]], config: Dict[str, Any]):
+        """Record a freshly built output and save the manifest."""
+        self.outputs[output_file] = {
+            "key": key,
+            "inputs": fingerprints,
+            "pipeline": pipeline_json,
+            "config": config,
+        }
+        self.save()
+
+    def save(self):
+        # write to a temp file first so a crash never leaves a half written manifest
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"outputs": self.outputs}, f, indent=4, default=str)
+        os.replace(tmp_path, self.path)
@@ -1,18 +1,103 @@
 # imports
-import pdal
 import json
 import os
+import sys
 import time
+import hashlib
+from datetime import datetime
 import numpy as np
+import pandas as pd
 import laspy
+from point_query import iter_points, query_bounds
 
-def run_pipe_with_time(pipeline, streaming=False, chunk_size=10000):
+try:
+    import resource  # not available on Windows
+except ImportError:
+    resource = None
+
+def peak_rss_mb(children: bool = False):
+    """
+    Peak resident memory of this process so far in MB (None if it can't be measured).
+    It never goes down, so a worker process reused across tasks reports its largest task so far.
+    With children, the peak of the largest child process that has finished and been waited
+    for (e.g. the workers of a closed process pool) instead - not their sum.
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+    if children:
+        return None
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 1024 ** 2
+    except (ImportError, AttributeError):
+        return None
+
+
+def pipeline_files(pipeline_json: str):
+    """Get the (input, output) filenames of a PDAL pipeline from its JSON."""
+    stages = json.loads(pipeline_json)
+    if isinstance(stages, dict):
+        stages = stages["pipeline"]
+    inputs, outputs = [], []
+    for i, stage in enumerate(stages):
+        if isinstance(stage, str):
+            # a bare filename is a writer if it's the last stage
+            (outputs if i == len(stages) - 1 else inputs).append(stage)
+        elif "filename" in stage:
+            if stage.get("type", "").startswith("readers."):
+                inputs.append(stage["filename"])
+            elif stage.get("type", "").startswith("writers."):
+                outputs.append(stage["filename"])
+    return inputs, outputs
+
+
+def file_bytes(files):
+    return sum(os.path.getsize(f) for f in files if os.path.isfile(f))
+
+
+def stage_counts(metadata):
+    """Get the point count reported by each stage in the pipeline metadata, where there is one."""
+    if isinstance(metadata, str):
+        metadata = json.loads(metadata)
+    counts = {}
+    for name, stage in metadata.get("metadata", {}).items():
+        for m in stage if isinstance(stage, list) else [stage]:
+            if isinstance(m, dict) and "count" in m:
+                counts[name] = counts.get(name, 0) + m["count"]
+    return counts
+
+
+def write_telemetry(record, telemetry):
+    """Send a run record to a callback, or append it to a JSONL file."""
+    if callable(telemetry):
+        telemetry(record)
+        return
+    os.makedirs(os.path.dirname(telemetry) or ".", exist_ok=True)
+    with open(telemetry, "a") as f:
+        f.write(json.dumps(record, default=str) + "\n")
+
+
+def run_pipe_with_time(pipeline, streaming=False, chunk_size=10000, telemetry=None, stage=None, tags=None):
     """
     Run a PDAL pipeline and measure the time taken.
+    Streams when requested and the pipeline is streamable, otherwise falls back
+    to standard mode (all points in memory) and says so. Returns the point count.
+
+    telemetry is a JSONL file path or a callback that receives a record of the run:
+    wall/CPU time, points/sec, peak RSS, input/output bytes, the mode and chunk size,
+    the point count of each stage, and a hash of the pipeline JSON. stage labels the
+    record (e.g. the tile being processed), so multi-pipeline runs can be broken down.
+    tags is a dict of extra fields for the record (e.g. the survey date).
     """
-    print("Starting PDAL pipeline execution in streaming mode..." if streaming else "Starting PDAL pipeline execution...")
+    if streaming and not pipeline.streamable:
+        print("Warning: pipeline is not streamable - falling back to standard mode (all points held in memory)")
+    streamed = streaming and pipeline.streamable
+    print(f"Starting PDAL pipeline execution in streaming mode (chunk size {chunk_size})..." if streamed else "Starting PDAL pipeline execution in standard mode...")
     start_time = time.time()
-    if streaming and pipeline.streamable:
+    start_cpu = time.process_time()
+    if streamed:
         # Execute the pipeline in streaming mode
         num_points = pipeline.execute_streaming(chunk_size)
     else:
@@ -21,36 +106,181 @@ def run_pipe_with_time(pipeline, streaming=False, chunk_size=10000):
     end_time = time.time()
     elapsed = end_time - start_time
     # print(pipeline.log)
-    print(f"Pipeline execution complete. Processed {num_points} points in {elapsed:.2f} seconds.")
+    mode = "streaming" if streamed else "standard"
+    print(f"Pipeline execution complete ({mode} mode). Processed {num_points} points in {elapsed:.2f} seconds.")
+
+    if telemetry is not None:
+        import pdal  # only needed for its version - the pipeline was built by the caller
+        pipeline_json = pipeline.pipeline
+        inputs, outputs = pipeline_files(pipeline_json)
+        try:
+            counts = stage_counts(pipeline.metadata)
+        except Exception:
+            counts = {}
+        record = {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "stage": stage,
+            "pipeline_hash": hashlib.sha256(pipeline_json.encode()).hexdigest()[:16],
+            "pdal_version": getattr(pdal, "__version__", None),
+            "mode": mode,
+            "chunk_size": chunk_size if streamed else None,
+            "points": num_points,
+            "wall_s": round(elapsed, 3),
+            "cpu_s": round(time.process_time() - start_cpu, 3),
+            "points_per_s": round(num_points / elapsed) if elapsed > 0 else None,
+            "peak_rss_mb": peak_rss_mb(),
+            "input_bytes": file_bytes(inputs),
+            "output_bytes": file_bytes(outputs),
+            "stage_counts": counts,
+            **(tags or {}),
+        }
+        write_telemetry(record, telemetry)
+    return num_points
+
+
+# only decode the dimensions the point metrics use (LAZ 1.4 files, other files are read in full)
+HAG_SELECTION = laspy.DecompressionSelection.XY_RETURNS_CHANNEL | laspy.DecompressionSelection.ALL_EXTRA_BYTES
+
+
+def iter_hag_chunks(las_path: str, chunk_size: int = 1_000_000, bounds=None, polygon=None):
+    """
+    Stream a LAS/LAZ file with HeightAboveGround in chunks, yielding (x, y, hag) arrays.
+    Only X, Y and the extra bytes are decompressed, so memory depends on chunk_size, not the file.
+    bounds (min_x, min_y, max_x, max_y) and/or polygon limit the read to the points
+    inside them - see point_query.iter_points.
+    """
+    with laspy.open(las_path) as reader:
+        if 'HeightAboveGround' not in reader.header.point_format.dimension_names:
+            raise RuntimeError("LAS file missing HeightAboveGround dimension")   # PDAL writes this extra dim
+    for points in iter_points(las_path, bounds, polygon, chunk_size, HAG_SELECTION):
+        yield np.asarray(points.x), np.asarray(points.y), np.asarray(points['HeightAboveGround'])
 
 
-def grid_cell_stem_proxy(las_path: str, grid=2.0, height_cutoff=2.0) -> float:
+def stem_proxy_matrix(las_path: str, grids=(1.0, 2.0, 3.0, 4.0, 5.0), height_cutoffs=(1.0, 2.0, 3.0, 4.0),
+                      chunk_size=1_000_000, bounds=None, polygon=None) -> pd.DataFrame:
+    """
+    Occupied-cell stem proxy (see grid_cell_stem_proxy) for every grid size × height
+    cutoff combination from one pass over the file.
+
+    Each point gets a level - the number of cutoffs below its HeightAboveGround - and
+    each grid keeps the highest level seen per cell, indexed by linear cell number.
+    A cell is occupied for a cutoff when its level is above the cutoff's position,
+    so no sorting or unique is needed and memory is one byte per cell per grid.
+
+    bounds (min_x, min_y, max_x, max_y) and/or a shapely polygon limit it to the
+    points inside them, read without touching the rest of the file. The grids then
+    only cover the query, snapped to the whole-file grid so the cells line up.
+
+    Returns one row per grid and cutoff: grid_m, height_cutoff_m, occupied_cells,
+    area_ha and stems_per_ha.
+    """
+    grids = [float(g) for g in grids]
+    cutoffs = np.sort(np.asarray(height_cutoffs, dtype=float))
+    with laspy.open(las_path) as reader:
+        mins, maxs = reader.header.mins[:2], reader.header.maxs[:2]
+    low, high = mins, maxs
+    box = query_bounds(bounds, polygon)
+    if box is not None:
+        low, high = np.maximum(box[:2], mins), np.minimum(box[2:], maxs)
+    origins = [mins + np.floor((low - mins) / g) * g for g in grids]
+    shapes = [(max(int((high[1] - o[1]) // g) + 1, 1), max(int((high[0] - o[0]) // g) + 1, 1))
+              for g, o in zip(grids, origins)]
+    levels = [np.zeros(ny * nx, dtype=np.uint8) for ny, nx in shapes]
+
+    # footprint of the points above each cutoff
+    foot_min = np.full((len(cutoffs), 2), np.inf)
+    foot_max = np.full((len(cutoffs), 2), -np.inf)
+    for x, y, hag in iter_hag_chunks(las_path, chunk_size, bounds, polygon):
+        level = np.searchsorted(cutoffs, hag, side='left').astype(np.uint8)
+        # searchsorted puts NaN above every cutoff - a point with no height is no stem
+        keep = (level > 0) & np.isfinite(hag)
+        if not keep.any():
+            continue
+        x, y, level = x[keep], y[keep], level[keep]
+        for k in range(len(cutoffs)):
+            above = level > k
+            if not above.any():
+                break
+            foot_min[k] = np.minimum(foot_min[k], [x[above].min(), y[above].min()])
+            foot_max[k] = np.maximum(foot_max[k], [x[above].max(), y[above].max()])
+
+        for g, origin, (ny, nx), cell_level in zip(grids, origins, shapes, levels):
+            gx = np.clip(((x - origin[0]) // g).astype(np.int64), 0, nx - 1)
+            gy = np.clip(((y - origin[1]) // g).astype(np.int64), 0, ny - 1)
+            np.maximum.at(cell_level, gy * nx + gx, level)
+
+    rows = []
+    for g, cell_level in zip(grids, levels):
+        counts = np.bincount(cell_level, minlength=len(cutoffs) + 1)
+        # cells at level k or above are occupied for cutoff k - 1
+        occupied = np.cumsum(counts[::-1])[::-1][1:]
+        for k, cutoff in enumerate(cutoffs):
+            # area covered = raster footprint (min→max) so density is consistent
+            area_ha = np.prod(foot_max[k] - foot_min[k]) / 10_000 if occupied[k] else 0.0
+            rows.append({
+                "grid_m": g,
+                "height_cutoff_m": float(cutoff),
+                "occupied_cells": int(occupied[k]),
+                "area_ha": area_ha,
+                "stems_per_ha": occupied[k] / area_ha if occupied[k] else 0.0,
+            })
+    return pd.DataFrame(rows)
+
+
+def grid_cell_stem_proxy(las_path: str, grid=2.0, height_cutoff=2.0, chunk_size=1_000_000,
+                         bounds=None, polygon=None) -> float:
     """
     Very lightweight stem‑density proxy:
-      • keep points with HeightAboveGround > 2 m (ignore grass/shrub noise)
-      • drop them into a grid (default 2 × 2 m)
+      • keep points with HeightAboveGround > 2 m (ignore grass/shrub noise)
+      • drop them into a grid (default 2 × 2 m)
       • assume one stem/cluster per occupied cell
-      • report stems ha⁻¹
+      • report stems ha⁻¹
+
+    The file is streamed in chunks into an occupancy grid sized from the header
+    bounds, so memory stays flat however many points the file has. The grid is
+    anchored at the header minimum rather than the minimum of the kept points.
+    Use stem_proxy_matrix to sweep several grids and cutoffs in one pass.
+    Pass bounds or a polygon to only read the points inside them (e.g. one rehab polygon).
     """
-    las = laspy.read(las_path)
-    try:
-        hag = las['HeightAboveGround']          # PDAL wrote this extra dim
-    except KeyError:
-        raise RuntimeError("LAS file missing HeightAboveGround dimension")
-
-    mask = hag > height_cutoff                              # metres
-    if mask.sum() == 0:
-        return 0.0
-
-    x = las.x[mask]
-    y = las.y[mask]
-
-    # snap to grid
-    gx = np.floor((x - x.min()) / grid).astype(np.int32)
-    gy = np.floor((y - y.min()) / grid).astype(np.int32)
-    occupied = np.unique(np.stack([gx, gy], axis=1), axis=0).shape[0]
-
-    # area covered = raster footprint (min→max) so density is consistent
-    area_m2 = (x.max() - x.min()) * (y.max() - y.min())
-    area_ha = area_m2 / 10_000
-    return occupied / area_ha                  # stems per hectare
\ No newline at end of file
+    result = stem_proxy_matrix(las_path, [grid], [height_cutoff], chunk_size, bounds, polygon)
+    return float(result["stems_per_ha"].iloc[0])
+
+
+REHAB_SHAPEFILE = os.path.join("output", "shapefiles", "rehab_poly_exploded", "rehab_poly_exploded.shp")
+PROCESSED_DIR = os.path.join("output", "processed")
+
+
+def load_rehab_shapes(file: str = REHAB_SHAPEFILE, crs: str = "EPSG:7856"):
+    """
+    Load the rehab polygons in the CHM CRS, with the poly_id (md5 of the centroid
+    "x,y" string) and short_id (its last 6 characters) used to key the metrics.
+    """
+    import geopandas as gpd
+    shapes = gpd.read_file(file).to_crs(crs)
+    centroids = shapes.geometry.centroid
+    coord_strings = centroids.x.astype(str) + ',' + centroids.y.astype(str)
+    shapes['poly_id'] = coord_strings.apply(lambda x: hashlib.md5(x.encode()).hexdigest())
+    shapes['short_id'] = shapes.poly_id.str[-6:]
+    return shapes
+
+
+def find_chm_by_date(processed_dir: str = PROCESSED_DIR):
+    """Find the CHM of each survey date - {date folder: path of its first chm*.tif}."""
+    chm_by_date = {}
+    for date_folder in sorted(os.listdir(processed_dir)):
+        date_path = os.path.join(processed_dir, date_folder)
+        if os.path.isdir(date_path):
+            chm_files = sorted(f for f in os.listdir(date_path) if f.startswith("chm") and f.endswith(".tif"))
+            if chm_files:
+                chm_by_date[date_folder] = os.path.relpath(os.path.join(date_path, chm_files[0]))
+    return chm_by_date
+
+
+def find_las_by_date(processed_dir: str = PROCESSED_DIR, filename: str = "lidar_combined.laz"):
+    """Find the merged point cloud of each survey date - {date folder: path of its filename}."""
+    las_by_date = {}
+    for date_folder in sorted(os.listdir(processed_dir)):
+        las_path = os.path.join(processed_dir, date_folder, filename)
+        if os.path.isfile(las_path):
+            las_by_date[date_folder] = os.path.relpath(las_path)
+    return las_by_date
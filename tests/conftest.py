@@ -0,0 +1,69 @@
+# shared fixtures for the tests - small synthetic inputs, no PDAL needed
+import numpy as np
+import laspy
+import pytest
+
+
+def write_hag_laz(path, x, y, hag, return_number=None, z=None):
+    """Write a LAZ 1.4 file with a HeightAboveGround extra dimension, like process_laz.py outputs."""
+    header = laspy.LasHeader(point_format=6, version="1.4")
+    header.add_extra_dim(laspy.ExtraBytesParams(name="HeightAboveGround", type=np.float32))
+    header.offsets = [float(np.min(x)), float(np.min(y)), 0.0]
+    header.scales = [0.01, 0.01, 0.01]
+    las = laspy.LasData(header)
+    las.x, las.y, las.z = x, y, hag if z is None else z
+    las.HeightAboveGround = hag
+    las.return_number = np.ones(len(x), dtype=np.uint8) if return_number is None else return_number
+    las.write(str(path))
+    return str(path)
+
+
+@pytest.fixture
+def hag_laz(tmp_path):
+    """A 100 x 80 m patch of 20,000 points, about a third of them above 2 m."""
+    rng = np.random.default_rng(0)
+    n = 20_000
+    x = 300_000 + rng.uniform(0, 100, n)
+    y = 6_425_000 + rng.uniform(0, 80, n)
+    hag = np.where(rng.random(n) < 0.35, rng.uniform(0, 12, n), rng.uniform(0, 0.3, n)).astype(np.float32)
+    return write_hag_laz(tmp_path / "hag.laz", x, y, hag)
+
+
+@pytest.fixture
+def chm_tif(tmp_path):
+    """A 0.5 m CHM of 240 x 200 pixels with bare ground, negative noise and NoData holes."""
+    import rasterio
+    from rasterio.transform import from_origin
+
+    rng = np.random.default_rng(1)
+    chm = np.where(rng.random((200, 240)) < 0.6, rng.gamma(2.0, 2.0, (200, 240)), 0.0).astype(np.float32)
+    chm[rng.random(chm.shape) < 0.05] = -0.2
+    chm[rng.random(chm.shape) < 0.05] = -9999
+    path = tmp_path / "chm_0.5.tif"
+    with rasterio.open(path, "w", driver="GTiff", width=240, height=200, count=1, dtype="float32", nodata=-9999,
+                       crs="EPSG:7856", transform=from_origin(300_000, 6_425_100, 0.5, 0.5),
+                       tiled=True, blockxsize=16, blockysize=16) as dst:
+        dst.write(chm, 1)
+    return str(path)
+
+
+@pytest.fixture
+def rehab_shapes():
+    """Three non-overlapping polygons inside chm_tif, with the columns the stats carry."""
+    import geopandas as gpd
+    from shapely.geometry import Polygon, box
+
+    return gpd.GeoDataFrame({
+        "MAP_NAME": ["North", "North", "South"],
+        "rehab_year": [2012, 2015, 2015],
+        "veg_type": ["woodland", "woodland", "pasture"],
+        "veg_method": ["seed", "tubestock", "seed"],
+        "rehab_zone": ["A", "B", "C"],
+        "retrofit": ["no", "yes", "no"],
+        "poly_id": ["0a1", "0b2", "0c3"],
+        "short_id": ["a1", "b2", "c3"],
+    }, geometry=[
+        box(300_005, 6_425_040, 300_050, 6_425_095),
+        Polygon([(300_060, 6_425_010), (300_115, 6_425_020), (300_090, 6_425_080)]),
+        box(300_002.3, 6_425_003.1, 300_040.7, 6_425_030.9),
+    ], crs="EPSG:7856")
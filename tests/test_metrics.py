@@ -0,0 +1,51 @@
+import numpy as np
+import polars as pl
+import statsmodels.api as sm
+
+from metrics import grouped_ols
+
+
+def polygon_series():
+    """Yearly heights and cover of a few polygons, with nulls, a 2 point polygon and one with nothing usable."""
+    rng = np.random.default_rng(3)
+    rows = []
+    for short_id, n, slope in [("a1", 8, 0.4), ("b2", 5, -0.1), ("c3", 12, 1.2), ("d4", 2, 0.3)]:
+        for i, year in enumerate(2015 + np.sort(rng.choice(15, n, replace=False))):
+            height = None if (short_id == "a1" and i == 3) else slope * (year - 2015) + rng.normal(0, 0.3)
+            rows.append({"short_id": short_id, "year": float(year), "p90_height_m": height,
+                         "woody_cover": float(np.clip(0.05 * (year - 2015) + rng.normal(0, 0.05), 0, 1))})
+    rows += [{"short_id": "e5", "year": 2020.0, "p90_height_m": None, "woody_cover": None}]
+    return pl.DataFrame(rows)
+
+
+def reference_ols(df, short_id, y):
+    """One statsmodels OLS fit, the way the notebooks fit each polygon."""
+    group = df.filter(pl.col("short_id") == short_id).drop_nulls([y])
+    return sm.OLS(group[y].to_numpy(), sm.add_constant(group["year"].to_numpy())).fit()
+
+
+def test_grouped_ols_matches_statsmodels():
+    df = polygon_series()
+    result = grouped_ols(df, "short_id", "year", ["p90_height_m", "woody_cover"])
+    assert result.height == 10
+    for row in result.filter(pl.col("short_id") != "e5").iter_rows(named=True):
+        model = reference_ols(df, row["short_id"], row["metric"])
+        assert row["n"] == model.nobs
+        np.testing.assert_allclose([row["intercept"], row["slope"], row["r_squared"]],
+                                   [model.params[0], model.params[1], model.rsquared], rtol=1e-8, atol=1e-10)
+        if row["n"] > 2:
+            np.testing.assert_allclose([row["std_error"], row["p_value"]], [model.bse[1], model.pvalues[1]],
+                                       rtol=1e-6)
+        else:
+            assert row["std_error"] is None and row["p_value"] is None
+    empty = result.filter(pl.col("short_id") == "e5")
+    assert empty.height == 2 and empty["slope"].null_count() == 2
+
+
+def test_grouped_ols_single_column():
+    df = polygon_series()
+    result = grouped_ols(df, "short_id", "year", "woody_cover")
+    assert "metric" not in result.columns
+    model = reference_ols(df, "c3", "woody_cover")
+    row = result.filter(pl.col("short_id") == "c3").row(0, named=True)
+    np.testing.assert_allclose([row["slope"], row["p_value"]], [model.params[1], model.pvalues[1]], rtol=1e-6)
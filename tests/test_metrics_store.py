@@ -0,0 +1,34 @@
+import datetime as dt
+
+import polars as pl
+
+from metrics_store import MetricsStore
+
+
+def chm_rows(date, short_ids, height=1.0):
+    return pl.DataFrame({
+        "date": [date] * len(short_ids),
+        "short_id": short_ids,
+        "rehab_year": [2015] * len(short_ids),
+        "p90_height_m": [height] * len(short_ids),
+    })
+
+
+def test_upsert_replaces_the_whole_date(tmp_path):
+    path = str(tmp_path / "metrics.duckdb")
+    jan, feb = dt.date(2024, 1, 1), dt.date(2024, 2, 1)
+    with MetricsStore(path) as store:
+        store.upsert(chm_rows(jan, ["a1", "b2", "c3"]), version=1)
+        store.upsert(chm_rows(feb, ["a1", "b2", "c3"]), version=1)
+        store.upsert(chm_rows(jan, ["a1", "b2", "c3"]), version=2)
+        # a polygon edit changed c3's short_id to d4 - the rerun of January replaces the whole date
+        assert store.upsert(chm_rows(jan, ["a1", "b2", "d4"], height=2.0), version=1) == 3
+
+    with MetricsStore(path, read_only=True) as store:
+        january = store.select(where="date = ?", params=[jan], version=1)
+        assert january["short_id"].to_list() == ["a1", "b2", "d4"]
+        assert january["p90_height_m"].to_list() == [2.0, 2.0, 2.0]
+        # other dates and other versions of the date are kept
+        assert store.select(where="date = ?", params=[feb], version=1).height == 3
+        assert store.select(where="date = ?", params=[jan], version=2)["short_id"].to_list() == ["a1", "b2", "c3"]
+        assert store.dates(1) == ["2024-01-01", "2024-02-01"]
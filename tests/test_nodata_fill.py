@@ -0,0 +1,39 @@
+import numpy as np
+from rasterio.fill import fillnodata
+
+from nodata_fill import fill_nodata
+
+NODATA = -9999
+
+
+def dtm_with_gaps():
+    """A sloping 300 x 260 surface with scattered holes and a few large gaps."""
+    rng = np.random.default_rng(2)
+    rows, cols = np.mgrid[0:300, 0:260]
+    dtm = (50 + 0.05 * rows + 0.02 * cols + rng.normal(0, 0.1, rows.shape)).astype(np.float32)
+    dtm[rng.random(dtm.shape) < 0.3] = NODATA
+    dtm[40:90, 100:200] = NODATA
+    dtm[150:300, 0:120] = NODATA  # wider than max_distance, so its middle stays nodata
+    return dtm
+
+
+def test_tiled_fill_matches_gdal_fill_of_the_whole_array():
+    dtm = dtm_with_gaps()
+    for max_distance in [5, 12]:
+        whole = fillnodata(dtm.copy(), mask=dtm != NODATA, max_search_distance=max_distance)
+        assert (whole == NODATA).any() and (whole != NODATA).sum() > (dtm != NODATA).sum()
+        for workers in [1, 2]:
+            tiled = fill_nodata(dtm, NODATA, max_distance=max_distance, tile_size=64, workers=workers)
+            np.testing.assert_array_equal(tiled, whole)
+    # the input is left as it was
+    np.testing.assert_array_equal(dtm, dtm_with_gaps())
+
+
+def test_fill_covers_the_search_distance():
+    dtm = np.full((61, 61), NODATA, dtype=np.float32)
+    dtm[30, 30] = 7.0
+    filled = fill_nodata(dtm, NODATA, max_distance=20, tile_size=16, workers=1)
+    rows, cols = np.mgrid[0:61, 0:61]
+    filled_distance = np.hypot(rows - 30, cols - 30)[filled != NODATA]
+    assert filled_distance.max() <= 20 and (filled != NODATA).sum() > 1200
+    np.testing.assert_allclose(filled[filled != NODATA], 7.0)
@@ -0,0 +1,55 @@
+import numpy as np
+import laspy
+
+from conftest import write_hag_laz
+
+from spatial_lib import grid_cell_stem_proxy, iter_hag_chunks, stem_proxy_matrix
+
+
+def reference_stem_proxy(las_path, grid, height_cutoff):
+    """Occupied grid cells with points above the cutoff per ha of their footprint, from the whole file at once."""
+    las = laspy.read(las_path)
+    x, y, hag = np.asarray(las.x), np.asarray(las.y), np.asarray(las.HeightAboveGround)
+    mins = las.header.mins
+    keep = hag > height_cutoff
+    cells = np.unique(np.stack([(x[keep] - mins[0]) // grid, (y[keep] - mins[1]) // grid]), axis=1)
+    area_ha = (x[keep].max() - x[keep].min()) * (y[keep].max() - y[keep].min()) / 10_000
+    return cells.shape[1] / area_ha
+
+
+def test_iter_hag_chunks_reads_every_point(hag_laz):
+    las = laspy.read(hag_laz)
+    chunks = list(iter_hag_chunks(hag_laz, chunk_size=3_000))
+    assert len(chunks) == 7
+    hag = np.concatenate([c[2] for c in chunks])
+    np.testing.assert_array_equal(hag, np.asarray(las.HeightAboveGround))
+
+
+def test_grid_cell_stem_proxy_matches_reference(hag_laz):
+    for grid, cutoff in [(2.0, 2.0), (1.0, 4.0), (5.0, 1.0)]:
+        result = grid_cell_stem_proxy(hag_laz, grid=grid, height_cutoff=cutoff, chunk_size=3_000)
+        assert np.isclose(result, reference_stem_proxy(hag_laz, grid, cutoff))
+
+
+def test_stem_proxy_matrix_matches_one_pass_per_cutoff(hag_laz):
+    grids, cutoffs = [1.0, 2.0, 3.5], [0.5, 2.0, 4.0, 8.0]
+    result = stem_proxy_matrix(hag_laz, grids, cutoffs, chunk_size=3_000)
+    assert len(result) == len(grids) * len(cutoffs)
+    for row in result.itertuples():
+        assert np.isclose(row.stems_per_ha, reference_stem_proxy(hag_laz, row.grid_m, row.height_cutoff_m))
+
+
+def test_stem_proxy_matrix_skips_points_without_a_height(hag_laz, tmp_path):
+    las = laspy.read(hag_laz)
+    x, y, hag = np.asarray(las.x), np.asarray(las.y), np.asarray(las.HeightAboveGround)
+    # points past the east edge with no height would widen the footprint and add cells if counted
+    n = 500
+    rng = np.random.default_rng(1)
+    nan_laz = write_hag_laz(tmp_path / "nan.laz", np.concatenate([x, 300_100 + rng.uniform(0, 50, n)]),
+                            np.concatenate([y, 6_425_000 + rng.uniform(0, 80, n)]),
+                            np.concatenate([hag, np.full(n, np.nan, dtype=np.float32)]),
+                            z=np.concatenate([hag, np.zeros(n, dtype=np.float32)]))
+    grids, cutoffs = [1.0, 2.0], [0.5, 4.0]
+    result = stem_proxy_matrix(nan_laz, grids, cutoffs, chunk_size=3_000)
+    for row in result.itertuples():
+        assert np.isclose(row.stems_per_ha, reference_stem_proxy(hag_laz, row.grid_m, row.height_cutoff_m))
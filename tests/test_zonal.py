@@ -0,0 +1,47 @@
+import numpy as np
+import rasterio
+from rasterio.features import geometry_mask
+
+from zonal import grouped_chm_stats, iter_windows, label_grid, zonal_stats
+
+
+def reference_zonal_stats(chm_file, shapes):
+    """P50, P90 and mean of the heights above 0 m in each polygon, masking the whole CHM one polygon at a time."""
+    with rasterio.open(chm_file) as src:
+        chm = src.read(1, masked=True)
+        result = {"p50_height_m": [], "p90_height_m": [], "mean_height_m": []}
+        for geometry in shapes.geometry:
+            inside = ~geometry_mask([geometry], out_shape=chm.shape, transform=src.transform)
+            values = chm.data[inside & ~np.ma.getmaskarray(chm)].astype(np.float64)
+            values = values[values > 0]
+            result["p50_height_m"].append(np.percentile(values, 50))
+            result["p90_height_m"].append(np.percentile(values, 90))
+            result["mean_height_m"].append(values.mean())
+    return {k: np.array(v) for k, v in result.items()}
+
+
+def test_exact_percentiles_match_np_percentile(chm_tif, rehab_shapes, tmp_path):
+    memory_mb = 0.5  # a few blocks per strip, so the stats are added up across strips
+    with rasterio.open(chm_tif) as src:
+        assert len(list(iter_windows(src, memory_mb))) > 1
+    labels = label_grid(rehab_shapes, chm_tif, cache_dir=str(tmp_path / "cache"), memory_mb=memory_mb)
+    stats = zonal_stats(chm_tif, rehab_shapes, labels, memory_mb=memory_mb)
+    expected = reference_zonal_stats(chm_tif, rehab_shapes)
+    for column in ["p50_height_m", "p90_height_m"]:
+        np.testing.assert_array_equal(stats[column], expected[column])
+    np.testing.assert_allclose(stats["mean_height_m"], expected["mean_height_m"])
+
+
+def test_histogram_percentiles_within_half_a_bin(chm_tif, rehab_shapes, tmp_path):
+    labels = label_grid(rehab_shapes, chm_tif, cache_dir=str(tmp_path / "cache"))
+    stats = zonal_stats(chm_tif, rehab_shapes, labels, exact=False)
+    expected = reference_zonal_stats(chm_tif, rehab_shapes)
+    bin_width = stats["histogram"].bin_width
+    for column in ["p50_height_m", "p90_height_m"]:
+        assert np.all(np.abs(stats[column] - expected[column]) <= bin_width / 2 + 1e-9)
+
+
+def test_warns_when_the_histogram_is_over_budget(chm_tif, capsys):
+    stats = grouped_chm_stats(chm_tif, n_groups=20, memory_mb=1)
+    assert "Warning: the histogram of 20 groups" in capsys.readouterr().out
+    assert stats["count"][0] > 0 and (stats["count"][1:] == 0).all()
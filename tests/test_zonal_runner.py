@@ -0,0 +1,23 @@
+import os
+
+import zonal_runner
+
+
+def test_run_returns_only_the_dates_written(chm_tif, rehab_shapes, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the label grid cache goes under output/
+    shapefile = str(tmp_path / "rehab.shp")
+    rehab_shapes.to_file(shapefile)
+    broken = tmp_path / "broken" / "chm_0.5.tif"
+    broken.parent.mkdir()
+    broken.write_bytes(b"not a tiff")
+    dataset_dir = str(tmp_path / "dataset")
+
+    computed = zonal_runner.run({"2024-01-01": chm_tif, "2024-02-01": str(broken)}, shapefile, dataset_dir, workers=1)
+    assert computed == ["2024-01-01"]
+    assert sorted(os.listdir(dataset_dir)) == ["date=2024-01-01", "manifest.json"]
+    df = zonal_runner.load_dataset(dataset_dir)
+    assert df.height == 3 and df["short_id"].n_unique() == 3
+
+    # nothing changed, so only the failed date is tried again
+    assert zonal_runner.run({"2024-01-01": chm_tif, "2024-02-01": str(broken)}, shapefile, dataset_dir,
+                            workers=1) == []
@@ -0,0 +1,159 @@
+# imports
+import hashlib
+import json
+import os
+import numpy as np
+import laspy
+import shapely
+from typing import List, Dict, Any, Iterable
+from xyz_ingest import iter_xyz_chunks, XYZ_CRS
+
+LIDAR_EXTENSIONS = ['.las', '.laz', '.xyz']
+INDEX_CACHE_DIR = os.path.join("output", "cache", "tile_index")
+DEFAULT_CRS = XYZ_CRS  # the surveys are all delivered in MGA56
+
+
+def scan_xyz_bounds(path: str) -> Dict[str, Any]:
+    """Get the bounds and point count of an XYZ text file by parsing it in chunks."""
+    mins = np.full(3, np.inf)
+    maxs = np.full(3, -np.inf)
+    count = 0
+    for xyz in iter_xyz_chunks(path):
+        mins = np.minimum(mins, xyz.min(axis=0))
+        maxs = np.maximum(maxs, xyz.max(axis=0))
+        count += len(xyz)
+    return {
+        "min_x": float(mins[0]), "min_y": float(mins[1]), "min_z": float(mins[2]),
+        "max_x": float(maxs[0]), "max_y": float(maxs[1]), "max_z": float(maxs[2]),
+        "point_count": count,
+        "crs": XYZ_CRS,
+        "class_counts": None,
+    }
+
+
+def read_las_info(path: str, chunk_size: int = 1_000_000) -> Dict[str, Any]:
+    """
+    Get the bounds, point count and CRS of a LAS/LAZ file from its header.
+    The class counts aren't in the header, so the Classification dimension is
+    read in chunks (only X/Y and Classification are decompressed for LAZ 1.4 files).
+    """
+    selection = laspy.DecompressionSelection.XY_RETURNS_CHANNEL | laspy.DecompressionSelection.CLASSIFICATION
+    with laspy.open(path, decompression_selection=selection) as reader:
+        header = reader.header
+        try:
+            crs = header.parse_crs()
+        except Exception:
+            crs = None
+        counts = np.zeros(256, dtype=np.int64)
+        for points in reader.chunk_iterator(chunk_size):
+            counts += np.bincount(np.asarray(points.classification), minlength=256)
+    return {
+        "min_x": float(header.mins[0]), "min_y": float(header.mins[1]), "min_z": float(header.mins[2]),
+        "max_x": float(header.maxs[0]), "max_y": float(header.maxs[1]), "max_z": float(header.maxs[2]),
+        "point_count": int(header.point_count),
+        "crs": crs.to_string() if crs is not None else None,
+        "class_counts": {str(c): int(n) for c, n in enumerate(counts) if n},
+    }
+
+
+def read_tile_info(path: str) -> Dict[str, Any]:
+    """Read the index entry for one LAS/LAZ/XYZ file."""
+    if path.lower().endswith('.xyz'):
+        return scan_xyz_bounds(path)
+    return read_las_info(path)
+
+
+class TileIndex:
+    """
+    Spatial index of the LAS/LAZ/XYZ files in one or more directories.
+
+    Each file's real bounds, point count, CRS and class counts are read once and
+    cached per directory (keyed by file size and mtime), so only new or changed
+    files are read again. Queries use an STRtree over the file bounds.
+    """
+
+    def __init__(self, directories: Iterable[str], extensions: List[str] = LIDAR_EXTENSIONS,
+                 cache_dir: str = INDEX_CACHE_DIR):
+        self.directories = list(directories)
+        self.extensions = extensions
+        self.cache_dir = cache_dir
+        self.tiles = {}
+        self.directory_of = {}
+        for directory in self.directories:
+            for path, entry in self._load_directory(directory).items():
+                self.tiles[path] = entry
+                self.directory_of[path] = directory
+        self.paths = sorted(self.tiles)
+        self.boxes = shapely.box(
+            [self.tiles[p]["min_x"] for p in self.paths],
+            [self.tiles[p]["min_y"] for p in self.paths],
+            [self.tiles[p]["max_x"] for p in self.paths],
+            [self.tiles[p]["max_y"] for p in self.paths],
+        )
+        self.tree = shapely.STRtree(self.boxes)
+
+    def _cache_path(self, directory: str) -> str:
+        key = hashlib.sha1(os.path.abspath(directory).encode()).hexdigest()[:12]
+        return os.path.join(self.cache_dir, f"{os.path.basename(os.path.normpath(directory))}_{key}.json")
+
+    def _load_directory(self, directory: str) -> Dict[str, Dict[str, Any]]:
+        cache_path = self._cache_path(directory)
+        cached = {}
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                cached = json.load(f)
+
+        tiles = {}
+        changed = False
+        for f in sorted(os.listdir(directory)):
+            if not any(f.lower().endswith(ext.lower()) for ext in self.extensions):
+                continue
+            path = os.path.join(directory, f)
+            stat = os.stat(path)
+            entry = cached.get(path)
+            if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+                print(f"  Indexing {path}")
+                entry = read_tile_info(path)
+                entry.update({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+                changed = True
+            tiles[path] = entry
+
+        if changed or len(tiles) != len(cached):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(cache_path, "w") as f:
+                json.dump(tiles, f, indent=2)
+        return tiles
+
+    def files_in(self, directory: str) -> List[str]:
+        """Get all indexed files from one of the directories."""
+        return [p for p in self.paths if self.directory_of[p] == directory]
+
+    def query_geometry(self, geometry) -> List[str]:
+        """Get the files whose bounds overlap a geometry (or array of geometries)."""
+        if not self.paths:
+            return []
+        geometries = np.atleast_1d(geometry)
+        geometry_idx, tile_idx = self.tree.query(geometries, predicate="intersects")
+        # drop tiles that only share an edge with the query
+        keep = ~shapely.touches(self.boxes[tile_idx], geometries[geometry_idx])
+        return [self.paths[i] for i in np.unique(tile_idx[keep])]
+
+    def query_bbox(self, min_x: float, min_y: float, max_x: float, max_y: float) -> List[str]:
+        """Get the files whose bounds overlap a bounding box."""
+        return self.query_geometry(shapely.box(min_x, min_y, max_x, max_y))
+
+    def query_shapefile(self, shapefile: str, crs: str = DEFAULT_CRS) -> List[str]:
+        """Get the files touching any polygon in a shapefile, e.g. the rehab polygons."""
+        import geopandas as gpd
+        shapes = gpd.read_file(shapefile).to_crs(crs)
+        return self.query_geometry(shapes.geometry.values)
+
+    def tile_of(self, path: str, tile_size: int) -> str:
+        """
+        Get the x_y key of the tile grid cell a file belongs to (bottom left indexed),
+        from the centre of its bounds rather than its filename.
+        """
+        t = self.tiles[path]
+        x = int((t["min_x"] + t["max_x"]) / 2 // tile_size * tile_size)
+        y = int((t["min_y"] + t["max_y"]) / 2 // tile_size * tile_size)
+        return f"{x}_{y}"
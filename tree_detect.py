@@ -0,0 +1,245 @@
+# imports
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import polars as pl
+import rasterio
+from rasterio.windows import Window
+from rasterio.features import shapes as raster_shapes
+from rasterio.transform import xy
+from scipy import ndimage
+import shapely
+from shapely.geometry import shape
+
+from spatial_lib import load_rehab_shapes, find_chm_by_date, REHAB_SHAPEFILE, PROCESSED_DIR
+
+
+#############################################
+# individual tree detection on the CHM - tree tops by variable window local maxima,
+# crowns by watershed, run in overlapping windows across a worker pool
+#############################################
+
+# Configuration section - edit these settings as needed
+class Config:
+    OUTPUT_DIR = os.path.join("output", "trees")  # One folder per date
+    WORKERS = os.cpu_count() or 1
+
+    # Windows - each worker reads a WINDOW_M square plus HALO_M on every side
+    # The halo must be wider than the largest crown so trees on the window edges are whole
+    WINDOW_M = 500
+    HALO_M = 10
+
+    # Tree tops
+    SMOOTH_SIGMA_M = 0.3  # Gaussian smoothing of the CHM before finding maxima (0 to disable)
+    MIN_TREE_HEIGHT = 2.0  # Maxima below this (m) are not trees
+    # Search window width (m) grows with height: CROWN_A + CROWN_B * height, within CROWN_MIN/MAX
+    CROWN_A = 1.0
+    CROWN_B = 0.15
+    CROWN_MIN = 1.0
+    CROWN_MAX = 8.0
+    WINDOW_BINS = 6  # Number of window widths the heights are binned into
+
+    # Crowns
+    CROWN_MIN_HEIGHT = 1.0  # CHM pixels below this (m) are never part of a crown
+    CROWN_HEIGHT_RATIO = 0.5  # Crown pixels must be at least this fraction of their tree top height
+
+
+def window_widths_px(res: float) -> np.ndarray:
+    """Odd search window widths in pixels, one per height bin."""
+    widths_m = np.linspace(Config.CROWN_MIN, Config.CROWN_MAX, Config.WINDOW_BINS)
+    return (np.round(widths_m / res / 2) * 2 + 1).astype(int)
+
+
+def find_tree_tops(chm: np.ndarray, res: float) -> np.ndarray:
+    """
+    Variable window local maxima. Each pixel's search window width comes from its
+    height (binned to WINDOW_BINS widths); it is a tree top when it is the maximum of
+    that window and at least MIN_TREE_HEIGHT. Returns the (row, col) of the tops.
+    """
+    widths = window_widths_px(res)
+    widths_m = np.clip(Config.CROWN_A + Config.CROWN_B * chm, Config.CROWN_MIN, Config.CROWN_MAX)
+    # nearest bin - the edges are halfway between the bin widths
+    bins = np.digitize(widths_m / res, (widths[:-1] + widths[1:]) / 2)
+
+    candidates = chm >= Config.MIN_TREE_HEIGHT
+    tops = np.zeros(chm.shape, dtype=bool)
+    for b, width in enumerate(widths):
+        in_bin = candidates & (bins == b)
+        if in_bin.any():
+            # square windows - separable, so far cheaper than a disk footprint
+            tops |= in_bin & (chm == ndimage.maximum_filter(chm, size=width, mode="nearest"))
+
+    rows, cols = np.nonzero(tops)
+    if len(rows):
+        # flat tops give several equal maxima - keep one per connected patch
+        labels, n = ndimage.label(tops, structure=np.ones((3, 3)))
+        _, first = np.unique(labels[rows, cols], return_index=True)
+        rows, cols = rows[first], cols[first]
+    return np.stack([rows, cols], axis=1)
+
+
+def segment_crowns(chm: np.ndarray, tops: np.ndarray) -> np.ndarray:
+    """
+    Watershed of the inverted CHM from the tree tops. Returns a label grid where
+    label i + 1 is the crown of tops[i] and 0 is not a crown.
+    """
+    # watershed_ift needs an unsigned integer image - centimetres from the top of the window
+    inverted = np.round((chm.max() - chm) * 100).clip(0, np.iinfo(np.uint16).max).astype(np.uint16)
+    markers = np.zeros(chm.shape, dtype=np.int32)
+    markers[chm < Config.CROWN_MIN_HEIGHT] = -1
+    markers[tops[:, 0], tops[:, 1]] = np.arange(1, len(tops) + 1)
+    labels = ndimage.watershed_ift(inverted, markers)
+    labels[labels < 0] = 0
+    labels[chm < Config.CROWN_MIN_HEIGHT] = 0
+
+    # trim crowns to the part above CROWN_HEIGHT_RATIO of their top
+    top_heights = np.concatenate([[0.0], chm[tops[:, 0], tops[:, 1]]])
+    labels[chm < Config.CROWN_HEIGHT_RATIO * top_heights[labels]] = 0
+    return labels
+
+
+def read_chm(src, window: Window) -> np.ndarray:
+    """Read a window of the CHM as float32 heights with nodata as 0."""
+    chm = src.read(1, window=window, masked=True).astype(np.float32)
+    return np.nan_to_num(chm.filled(0), nan=0.0)
+
+
+def process_window(chm_file: str, core: Tuple[int, int, int, int], halo_px: int) -> List[Dict[str, Any]]:
+    """
+    Find the trees in one window of the CHM. core is (col_off, row_off, width, height)
+    in pixels; the window read is grown by halo_px on every side. Only trees whose top
+    is inside the core are returned, so neighbouring windows never report the same tree.
+    """
+    with rasterio.open(chm_file) as src:
+        col_off, row_off, width, height = core
+        read_col = max(col_off - halo_px, 0)
+        read_row = max(row_off - halo_px, 0)
+        window = Window(read_col, read_row,
+                        min(col_off + width + halo_px, src.width) - read_col,
+                        min(row_off + height + halo_px, src.height) - read_row)
+        chm = read_chm(src, window)
+        transform = src.window_transform(window)
+        res = src.res[0]
+
+    if not (chm >= Config.MIN_TREE_HEIGHT).any():
+        return []
+    smoothed = ndimage.gaussian_filter(chm, Config.SMOOTH_SIGMA_M / res) if Config.SMOOTH_SIGMA_M else chm
+    tops = find_tree_tops(smoothed, res)
+    if not len(tops):
+        return []
+    labels = segment_crowns(smoothed, tops)
+
+    # keep the trees with their top in the core
+    in_core = ((tops[:, 0] + read_row >= row_off) & (tops[:, 0] + read_row < row_off + height) &
+               (tops[:, 1] + read_col >= col_off) & (tops[:, 1] + read_col < col_off + width))
+    keep = np.nonzero(in_core)[0]
+    crown_pixels = ndimage.sum_labels(np.ones_like(labels), labels, keep + 1)
+    crowns = {}
+    kept_labels = np.where(np.isin(labels, keep + 1), labels, 0)
+    for geom, label in raster_shapes(kept_labels, mask=kept_labels > 0, transform=transform):
+        crowns.setdefault(int(label), []).append(shape(geom))
+
+    trees = []
+    for i, pixels in zip(keep, crown_pixels):
+        row, col = tops[i]
+        x, y = xy(transform, row, col)
+        trees.append({
+            "x": x,
+            "y": y,
+            "height_m": float(chm[row, col]),
+            "crown_area_m2": float(pixels * res * res),
+            "crown": shapely.union_all(crowns[i + 1]) if i + 1 in crowns else None,
+        })
+    return trees
+
+
+def chm_windows(chm_file: str, window_m: float) -> Tuple[List[Tuple[int, int, int, int]], int]:
+    """Split the CHM into core windows of about window_m metres, and the halo in pixels."""
+    with rasterio.open(chm_file) as src:
+        res = src.res[0]
+        size = max(int(window_m / res), 1)
+        cores = [
+            (col, row, min(size, src.width - col), min(size, src.height - row))
+            for row in range(0, src.height, size)
+            for col in range(0, src.width, size)
+        ]
+    return cores, int(np.ceil(Config.HALO_M / res))
+
+
+def detect_trees(chm_file: str, workers: int = None):
+    """Detect the trees in a CHM across a worker pool. Returns a GeoDataFrame of tree tops with crowns."""
+    import geopandas as gpd
+
+    workers = workers or Config.WORKERS
+    cores, halo_px = chm_windows(chm_file, Config.WINDOW_M)
+    with rasterio.open(chm_file) as src:
+        crs = src.crs
+
+    trees = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for window_trees in executor.map(process_window, [chm_file] * len(cores), cores,
+                                         [halo_px] * len(cores)):
+            trees.extend(window_trees)
+
+    tops = gpd.GeoDataFrame(
+        [{k: v for k, v in t.items() if k != "crown"} for t in trees],
+        geometry=gpd.points_from_xy([t["x"] for t in trees], [t["y"] for t in trees]),
+        crs=crs,
+    )
+    tops["crown"] = gpd.GeoSeries([t["crown"] for t in trees], crs=crs)
+    return tops
+
+
+def trees_by_polygon(trees, shapes, date: str):
+    """Assign the trees to the rehab polygons and summarise per polygon."""
+    import geopandas as gpd
+
+    joined = gpd.sjoin(trees, shapes[["short_id", "geometry"]], predicate="within")
+    per_polygon = joined.groupby("short_id").agg(
+        tree_count=("height_m", "size"),
+        mean_tree_height_m=("height_m", "mean"),
+        mean_crown_area_m2=("crown_area_m2", "mean"),
+    )
+    summary = shapes[["MAP_NAME", "short_id"]].join(per_polygon, on="short_id")
+    summary["tree_count"] = summary.tree_count.fillna(0).astype(int)
+    summary["stems_per_ha"] = summary.tree_count / (shapes.geometry.area / 10_000)
+    summary.insert(0, "date", date)
+    return joined, pl.DataFrame(summary.to_dict("list")).with_columns(pl.col("date").str.to_date("%Y-%m-%d"))
+
+
+def run_date(date: str, chm_file: str, shapes, output_dir: str = None, workers: int = None):
+    """Detect the trees for one survey date and write the tops, crowns and per-polygon summary."""
+    output_dir = os.path.join(output_dir or Config.OUTPUT_DIR, date)
+    os.makedirs(output_dir, exist_ok=True)
+
+    start_time = time.time()
+    print(f"Detecting trees in {chm_file}")
+    trees = detect_trees(chm_file, workers)
+    joined, summary = trees_by_polygon(trees, shapes, date)
+    print(f"  {len(trees):,} trees, {len(joined):,} in rehab polygons ({time.time() - start_time:.1f}s)")
+
+    joined = joined.drop(columns=["index_right"])
+    joined.drop(columns=["crown"]).to_file(os.path.join(output_dir, "tree_tops.gpkg"), driver="GPKG")
+    joined.set_geometry("crown").drop(columns=["geometry"]).to_file(
+        os.path.join(output_dir, "crowns.gpkg"), driver="GPKG")
+    summary.write_parquet(os.path.join(output_dir, "trees_by_polygon.parquet"))
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Detect trees and crowns on the CHM of each survey date.')
+    parser.add_argument('--date', action='append', help='Survey date folder to process (default all)')
+    parser.add_argument('--processed', default=PROCESSED_DIR, help='Folder with one subfolder of rasters per date')
+    parser.add_argument('--shapes', default=REHAB_SHAPEFILE, help='Rehab polygon shapefile')
+    parser.add_argument('--output', default=Config.OUTPUT_DIR, help='Output folder')
+    parser.add_argument('--workers', type=int, default=Config.WORKERS, help='Worker processes')
+
+    args = parser.parse_args()
+    shapes = load_rehab_shapes(args.shapes)
+    chm_by_date = find_chm_by_date(args.processed)
+    for date in args.date or sorted(chm_by_date):
+        run_date(date, chm_by_date[date], shapes, args.output, args.workers)
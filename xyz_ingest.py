@@ -0,0 +1,122 @@
+# imports
+import mmap
+import os
+import hashlib
+import numpy as np
+import laspy
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List
+
+XYZ_CACHE_DIR = os.path.join("output", "cache", "xyz")
+XYZ_CRS = "EPSG:7856"
+
+
+def iter_xyz_chunks(path: str, chunk_bytes: int = 64 * 1024 * 1024) -> Iterator[np.ndarray]:
+    """
+    Parse an XYZ text file in chunks, yielding (n, 3) float64 arrays.
+    The file is memory-mapped and cut into newline-aligned slices which are
+    parsed in one vectorised call each. A non-numeric header line is skipped.
+    """
+    if os.path.getsize(path) == 0:
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+        start = 0
+        first_newline = mm.find(b"\n")
+        first_line = mm[:first_newline if first_newline != -1 else size].strip()
+        if first_line and first_line[:1] not in b"+-.0123456789":
+            start = first_newline + 1 if first_newline != -1 else size
+
+        while start < size:
+            end = min(start + chunk_bytes, size)
+            if end < size:
+                # cut at the last full line in the chunk
+                newline = mm.rfind(b"\n", start, end)
+                if newline == -1:
+                    # a line longer than the chunk
+                    newline = mm.find(b"\n", end)
+                end = size if newline == -1 else newline + 1
+            data = mm[start:end]
+            start = end
+            values = np.fromstring(data.replace(b",", b" "), sep=" ")
+            if values.size % 3:
+                raise ValueError(f"{path} does not have 3 columns per line (X Y Z)")
+            if values.size:
+                yield values.reshape(-1, 3)
+
+
+def cached_laz_path(xyz_path: str, classification: int, cache_dir: str = XYZ_CACHE_DIR) -> str:
+    """Get the path of the cached LAZ conversion of an XYZ file."""
+    rel_dir = os.path.relpath(os.path.dirname(os.path.abspath(xyz_path)))
+    if rel_dir.startswith(".."):
+        # outside the project - key the cache folder on the absolute path instead
+        rel_dir = hashlib.sha1(os.path.dirname(os.path.abspath(xyz_path)).encode()).hexdigest()[:12]
+    stem = os.path.splitext(os.path.basename(xyz_path))[0]
+    return os.path.join(cache_dir, rel_dir, f"{stem}_class{classification}.laz")
+
+
+def convert_xyz_to_laz(xyz_path: str, laz_path: str, classification: int = 0, crs: str = XYZ_CRS,
+                       chunk_bytes: int = 64 * 1024 * 1024) -> int:
+    """
+    Convert an XYZ text file to LAZ with the given classification and CRS.
+    Written in chunks so memory is bounded by chunk_bytes. Returns the point count.
+    """
+    import pyproj
+
+    os.makedirs(os.path.dirname(laz_path), exist_ok=True)
+    tmp_path = laz_path + ".tmp.laz"
+    count = 0
+    writer = None
+    try:
+        for xyz in iter_xyz_chunks(xyz_path, chunk_bytes):
+            if writer is None:
+                # offsets from the first chunk, millimetre scales like the vendor LAS files
+                header = laspy.LasHeader(point_format=6, version="1.4")
+                header.offsets = np.floor(xyz.min(axis=0))
+                header.scales = np.array([0.001, 0.001, 0.001])
+                header.add_crs(pyproj.CRS.from_user_input(crs))
+                writer = laspy.open(tmp_path, mode="w", header=header, do_compress=True)
+            points = laspy.ScaleAwarePointRecord.zeros(len(xyz), header=writer.header)
+            points.x = xyz[:, 0]
+            points.y = xyz[:, 1]
+            points.z = xyz[:, 2]
+            points.classification = np.full(len(xyz), classification, dtype=np.uint8)
+            writer.write_points(points)
+            count += len(xyz)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        raise ValueError(f"{xyz_path} has no points")
+    os.replace(tmp_path, laz_path)
+    return count
+
+
+def ensure_laz(xyz_path: str, classification: int = 0, cache_dir: str = XYZ_CACHE_DIR) -> str:
+    """
+    Get a LAZ version of an XYZ file, converting it the first time (or when the
+    XYZ file is newer than the cached copy). Later runs reuse the cached LAZ.
+    """
+    laz_path = cached_laz_path(xyz_path, classification, cache_dir)
+    if not os.path.exists(laz_path) or os.path.getmtime(laz_path) < os.path.getmtime(xyz_path):
+        print(f"  Converting {xyz_path} to {laz_path}")
+        convert_xyz_to_laz(xyz_path, laz_path, classification)
+    return laz_path
+
+
+def convert_xyz_files(files: List[str], classification: int = 0, cache_dir: str = XYZ_CACHE_DIR,
+                      workers: int = 1) -> Dict[str, str]:
+    """
+    Make sure every XYZ file in files has a cached LAZ, converting in parallel.
+    Returns a mapping of XYZ path to cached LAZ path (other files aren't included).
+    """
+    xyz_files = [f for f in files if f.lower().endswith('.xyz')]
+    if not xyz_files:
+        return {}
+    if workers > 1 and len(xyz_files) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(xyz_files))) as executor:
+            laz_files = list(executor.map(ensure_laz, xyz_files, [classification] * len(xyz_files),
+                                          [cache_dir] * len(xyz_files)))
+    else:
+        laz_files = [ensure_laz(f, classification, cache_dir) for f in xyz_files]
+    return dict(zip(xyz_files, laz_files))
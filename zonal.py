@@ -0,0 +1,266 @@
+# imports
+import hashlib
+import os
+import re
+import time
+from typing import Dict, Iterator, List
+
+import numpy as np
+import polars as pl
+import rasterio
+from rasterio.features import rasterize
+from rasterio.windows import Window, transform as window_transform
+
+from height_hist import HeightHistogram
+
+LABEL_CACHE_DIR = os.path.join("output", "cache", "zonal")
+WOODY_HEIGHT = 1.0  # metres - dense woody threshold
+STATS_VERSION = 1  # Bump when the stats change - stored as metric_version in metrics_store.py
+
+# CHM strips are sized to keep each strip and its working arrays within the budget
+MEMORY_BUDGET_MB = 256
+BYTES_PER_PIXEL = 48
+
+# polygon attributes carried into rehab_chm_stats.parquet
+SHAPE_COLUMNS = ["MAP_NAME", "rehab_year", "veg_type", "veg_method", "rehab_zone", "retrofit", "poly_id", "short_id"]
+
+
+def chm_resolution(chm_file: str) -> float:
+    """Get the resolution from a chm_<res>.tif filename (None if it doesn't match)."""
+    match = re.search(r'chm_([0-9.]+)\.tif', chm_file)
+    return float(match.group(1)) if match else None
+
+
+def grid_key(shapes, crs, transform, width: int, height: int) -> str:
+    """Hash the polygons and a raster grid - a label grid is reused only when both match."""
+    h = hashlib.sha256()
+    for geometry in shapes.geometry.to_wkb():
+        h.update(geometry)
+    h.update(str((crs.to_string() if crs else None, tuple(transform), width, height)).encode())
+    return h.hexdigest()[:16]
+
+
+def label_key(shapes, src) -> str:
+    """grid_key of the polygons on a raster's grid."""
+    return grid_key(shapes, src.crs, src.transform, src.width, src.height)
+
+
+def iter_windows(src, memory_mb: float = None) -> Iterator[Window]:
+    """
+    Split a raster into full width strips of whole internal blocks, as many rows as
+    fit in memory_mb (at BYTES_PER_PIXEL for the pixel and its working arrays).
+    """
+    memory_mb = MEMORY_BUDGET_MB if memory_mb is None else memory_mb
+    block_rows = src.block_shapes[0][0]
+    rows = int(memory_mb * 1024 ** 2 // (src.width * BYTES_PER_PIXEL))
+    rows = max(block_rows, rows // block_rows * block_rows)
+    for row in range(0, src.height, rows):
+        yield Window(0, row, src.width, min(rows, src.height - row))
+
+
+def rasterize_labels(shapes, transform, width: int, height: int, key: str, strips: List[Window],
+                     cache_dir: str = LABEL_CACHE_DIR) -> np.ndarray:
+    """
+    Rasterise the polygons onto a grid one strip at a time into labels_<key>.npy and
+    return it memory-mapped (see label_grid). An existing file for the key is reused.
+    """
+    cache_path = os.path.join(cache_dir, f"labels_{key}.npy")
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        dtype = np.uint16 if len(shapes) < np.iinfo(np.uint16).max else np.uint32
+        # per process, so workers rasterising the same grid don't collide
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp.npy"
+        labels = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=(height, width))
+        for window in strips:
+            labels[window.row_off:window.row_off + window.height] = rasterize(
+                zip(shapes.geometry, range(1, len(shapes) + 1)),
+                out_shape=(window.height, window.width),
+                transform=window_transform(window, transform),
+                fill=0,
+                dtype=dtype,
+            )
+        labels.flush()
+        del labels
+        if os.path.exists(cache_path):
+            os.remove(tmp_path)  # another worker got there first
+        else:
+            os.replace(tmp_path, cache_path)
+    return np.load(cache_path, mmap_mode="r")
+
+
+def label_grid(shapes, chm_file: str, cache_dir: str = LABEL_CACHE_DIR, memory_mb: float = None) -> np.ndarray:
+    """
+    Rasterise the polygons onto the CHM grid: pixel value i + 1 is shapes.iloc[i],
+    0 is outside every polygon. Pixels are in a polygon when their centre is, the
+    same rule rasterio.mask uses; where polygons overlap the later one wins. Cached
+    by polygons and grid, so every date with the same CHM grid shares one rasterisation.
+
+    The grid is rasterised strip by strip into a .npy file and returned memory-mapped,
+    so it is never fully in memory.
+    """
+    with rasterio.open(chm_file) as src:
+        return rasterize_labels(shapes, src.transform, src.width, src.height, label_key(shapes, src),
+                                list(iter_windows(src, memory_mb)), cache_dir)
+
+
+def grouped_chm_stats(chm_file: str, labels: np.ndarray = None, n_groups: int = 1, qs: List[float] = (50, 90),
+                      positive_only: bool = True, memory_mb: float = None, exact: bool = True) -> Dict[str, np.ndarray]:
+    """
+    Count, mean, woody cover and percentiles of the CHM per label, reading the raster
+    one strip of blocks at a time so memory stays within memory_mb. The per-group
+    histogram (HeightHistogram.nbytes, about 80 KB per group) is taken out of the
+    budget before the strips are sized, down to a minimum of one row of blocks per
+    strip. The histogram is held whatever the budget, so with more groups than fit
+    (about 3,000 at the default budget) it warns and reads one row of blocks at a time.
+
+    labels is a grid the size of the CHM (e.g. the memory-mapped label_grid) where
+    label i + 1 is group i and 0 is ignored; None puts every pixel in group 0.
+    NoData pixels are ignored, and with positive_only heights <= 0 are too.
+
+    Count, sum and woody count simply add up across strips, and so does the per-group
+    HeightHistogram, returned as "histogram" so it can be merged with other tiles or
+    dates. With exact the percentiles are identical to np.percentile over all the
+    pixels: a second pass collects only the pixels in the histogram bins holding each
+    percentile's ranks. Those pixels are kept until the end and are not counted in the
+    budget - usually a small share of the raster, but every pixel of a large area
+    at one height (to the centimetre) lands in the same bin. Otherwise the percentiles
+    come from the histogram in one pass, within HIST_BIN / 2.
+    """
+    qs = list(qs)
+    counts = np.zeros(n_groups, dtype=np.int64)
+    sums = np.zeros(n_groups)
+    woody = np.zeros(n_groups, dtype=np.int64)
+    hist = HeightHistogram(n_groups)
+
+    with rasterio.open(chm_file) as src:
+        pixel_area = src.res[0] * src.res[1]
+        # the histogram is held for the whole read, so it comes out of the strip budget
+        budget_mb = MEMORY_BUDGET_MB if memory_mb is None else memory_mb
+        hist_mb = hist.nbytes / 1024 ** 2
+        if hist_mb >= budget_mb:
+            print(f"  Warning: the histogram of {n_groups} groups needs {hist_mb:,.0f} MB, over the {budget_mb:,.0f} MB "
+                  "budget - reading one row of blocks at a time")
+        strip_mb = max(budget_mb - hist_mb, 0)
+        windows = list(iter_windows(src, strip_mb))
+
+        def read_window(window):
+            chm = src.read(1, window=window, masked=True)
+            valid = ~np.ma.getmaskarray(chm) & ~np.isnan(chm.data)
+            values = chm.data
+            if positive_only:
+                valid &= values > 0
+            if labels is None:
+                ids = np.zeros(int(valid.sum()), dtype=np.int64)
+            else:
+                window_labels = np.asarray(labels[window.row_off:window.row_off + window.height])
+                valid &= window_labels > 0
+                ids = window_labels[valid].astype(np.int64) - 1
+            return ids, values[valid].astype(np.float64)
+
+        # pass 1 - running sums and the per-group histograms
+        cached = None
+        for window in windows:
+            ids, values = read_window(window)
+            if len(windows) == 1:
+                cached = ids, values
+            counts += np.bincount(ids, minlength=n_groups)
+            sums += np.bincount(ids, weights=values, minlength=n_groups)
+            woody += np.bincount(ids[values > WOODY_HEIGHT], minlength=n_groups)
+            hist.add(values, ids)
+
+        if exact:
+            # the bins holding the ranks either side of each percentile
+            groups, positions, lower, upper = hist.rank_positions(qs)
+            rank_groups = np.tile(groups, 2 * len(qs))
+            rank_bins, rank_in_bin = hist.locate(np.concatenate(lower + upper), rank_groups)
+            rank_keys = rank_groups * hist.n_bins + rank_bins
+            needed = np.unique(rank_keys)
+
+            # pass 2 - only the pixels in those bins
+            found_keys, found_values = [], []
+            for window in windows:
+                ids, values = cached if cached is not None else read_window(window)
+                keys = ids * hist.n_bins + hist.bins(values)
+                keep = np.isin(keys, needed)
+                found_keys.append(keys[keep])
+                found_values.append(values[keep])
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        stats = {
+            "count": counts,
+            "area_m2": counts * pixel_area,
+            "mean": sums / counts,
+            "woody_cover": woody / counts,
+            "histogram": hist,
+        }
+    if exact:
+        found_keys = np.concatenate(found_keys)
+        found_values = np.concatenate(found_values)
+        order = np.lexsort((found_values, found_keys))
+        found_keys, found_values = found_keys[order], found_values[order]
+        rank_values = found_values[np.searchsorted(found_keys, rank_keys) + rank_in_bin].reshape(2, len(qs), len(groups))
+        percentiles = np.full((len(qs), n_groups), np.nan)
+        for i in range(len(qs)):
+            percentiles[i, groups] = rank_values[0, i] + (rank_values[1, i] - rank_values[0, i]) * (positions[i] - lower[i])
+    else:
+        percentiles = hist.quantile(qs)
+    for q, percentile in zip(qs, percentiles):
+        stats[f"p{q:g}"] = percentile
+    return stats
+
+
+def zonal_stats(chm_file: str, shapes, labels: np.ndarray = None, memory_mb: float = None,
+                exact: bool = True) -> Dict[str, np.ndarray]:
+    """
+    Area, mean, P50, P90 and woody cover of the CHM in every polygon in one pass
+    over the raster strips. Pixels with height <= 0 (NoData or bare ground) are left
+    out, as in the notebooks. Returns arrays indexed like shapes, plus the polygons'
+    HeightHistogram. With exact False the percentiles come from the histogram in one pass.
+    """
+    if labels is None:
+        labels = label_grid(shapes, chm_file, memory_mb=memory_mb)
+    stats = grouped_chm_stats(chm_file, labels, len(shapes), [50, 90], memory_mb=memory_mb, exact=exact)
+    return {
+        "count": stats["count"],
+        "area_m2_from_chm": stats["area_m2"],
+        "mean_height_m": stats["mean"],
+        "p90_height_m": stats["p90"],
+        "p50_height_m": stats["p50"],
+        "woody_cover": stats["woody_cover"],
+        "histogram": stats["histogram"],
+    }
+
+
+def chm_stats(date: str, chm_file: str, shapes, memory_mb: float = None) -> pl.DataFrame:
+    """
+    Stats of every polygon with CHM pixels for one date, in the rehab_chm_stats.parquet
+    layout (the date is left as the folder name string).
+    """
+    stats = zonal_stats(chm_file, shapes, memory_mb=memory_mb)
+    has = stats["count"] > 0
+    table = {"date": [date] * int(has.sum())}
+    for column in SHAPE_COLUMNS:
+        table[column] = shapes[column].to_numpy()[has].tolist()
+    table["chm_resolution_m"] = [chm_resolution(chm_file)] * int(has.sum())
+    table["area_m2_from_chm"] = stats["area_m2_from_chm"][has]
+    table["area_m2_from_ge"] = shapes.geometry.area.to_numpy()[has]
+    for column in ["mean_height_m", "p90_height_m", "p50_height_m", "woody_cover"]:
+        table[column] = stats[column][has]
+    return pl.DataFrame(table)
+
+
+def chm_stats_by_date(chm_by_date: Dict[str, str], shapes) -> pl.DataFrame:
+    """Stats of every polygon for every date, as written to rehab_chm_stats.parquet."""
+    frames = []
+    for date, chm_file in chm_by_date.items():
+        if chm_resolution(chm_file) is None:
+            print(f"  Warning: Could not extract resolution from {chm_file}")
+            continue
+        print(f"Processing {date}: {chm_file}")
+        start_time = time.time()
+        frames.append(chm_stats(date, chm_file, shapes))
+        print(f"  {frames[-1].height} polygons in {time.time() - start_time:.1f}s")
+    if not frames:
+        return pl.DataFrame()
+    df = pl.concat(frames, how="vertical_relaxed")
+    return df.with_columns(pl.col("date").str.to_date("%Y-%m-%d"))
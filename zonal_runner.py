@@ -0,0 +1,173 @@
+# imports
+import multiprocessing
+import os
+import shutil
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List
+
+import polars as pl
+
+from metrics_store import MetricsStore, STORE_FILE
+from rebuild_cache import BuildManifest
+from spatial_lib import load_rehab_shapes, find_chm_by_date, REHAB_SHAPEFILE, PROCESSED_DIR
+from zonal import chm_stats, chm_resolution, MEMORY_BUDGET_MB, SHAPE_COLUMNS, STATS_VERSION
+
+
+#############################################
+# per-date zonal CHM stats across a process pool, written as a date=/short_id= partitioned Parquet dataset
+#############################################
+
+# Configuration section - edit these settings as needed
+class Config:
+    DATASET_DIR = os.path.join("output", "calc_stats", "rehab_chm_stats")  # Partitioned dataset
+    # Everything in one file as well, for the notebooks and chm_stats_viz.py (None to skip)
+    COMBINED_FILE = os.path.join("output", "calc_stats", "rehab_chm_stats.parquet")
+    STORE_FILE = STORE_FILE  # DuckDB metrics store the new dates are upserted into (None to skip)
+    WORKERS = max((os.cpu_count() or 1) // 2, 1)  # Each worker holds one CHM strip at a time
+    MEMORY_MB = MEMORY_BUDGET_MB  # Strip budget per worker
+    STATS_VERSION = STATS_VERSION  # Bump in zonal.py when the stats change so every date is recomputed
+
+
+SHAPEFILE_PARTS = [".shp", ".shx", ".dbf", ".prj", ".cpg"]
+
+
+def shapefile_parts(shapefile: str) -> List[str]:
+    """The files of a shapefile that exist - the attributes and CRS live in the .dbf and .prj, not the .shp."""
+    stem = os.path.splitext(shapefile)[0]
+    return [stem + ext for ext in SHAPEFILE_PARTS if os.path.exists(stem + ext)]
+
+
+def partition_dir(dataset_dir: str, date: str) -> str:
+    return os.path.join(dataset_dir, f"date={date}")
+
+
+def run_unit(date: str, chm_file: str, shapes, dataset_dir: str, memory_mb: float) -> int:
+    """
+    Compute one date's stats and write them as one file per short_id under date=<date>.
+    The partition is written to a temporary folder and renamed into place, so a crash
+    never leaves a half written date. Returns the number of polygons written.
+    """
+    df = chm_stats(date, chm_file, shapes, memory_mb=memory_mb).drop("date")
+    final_dir = partition_dir(dataset_dir, date)
+    tmp_dir = final_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    for (short_id,), polygon_df in df.partition_by("short_id", as_dict=True).items():
+        polygon_dir = os.path.join(tmp_dir, f"short_id={short_id}")
+        os.makedirs(polygon_dir, exist_ok=True)
+        polygon_df.drop("short_id").write_parquet(os.path.join(polygon_dir, "part-0.parquet"))
+    os.makedirs(tmp_dir, exist_ok=True)
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.replace(tmp_dir, final_dir)
+    return df.height
+
+
+def load_dataset(dataset_dir: str = None, dates: List[str] = None) -> pl.DataFrame:
+    """
+    Read the partitioned dataset back into one DataFrame, in the rehab_chm_stats.parquet layout.
+    dates limits it to those date partitions (the other partitions aren't read).
+    """
+    dataset_dir = dataset_dir or Config.DATASET_DIR
+    # keep the partition values as strings - a short_id can look like a number
+    lf = pl.scan_parquet(os.path.join(dataset_dir, "date=*", "short_id=*", "*.parquet"), hive_partitioning=True,
+                         hive_schema={"date": pl.Utf8, "short_id": pl.Utf8})
+    if dates is not None:
+        lf = lf.filter(pl.col("date").is_in(list(dates)))
+    df = lf.collect()
+    columns = ["date", *SHAPE_COLUMNS]
+    return (df
+            .with_columns(pl.col("date").str.to_date("%Y-%m-%d"))
+            .select([*columns, *[c for c in df.columns if c not in columns]])
+            .sort(["date", "short_id"]))
+
+
+def sync_store(store_file: str, dataset_dir: str = None, dates: List[str] = ()) -> int:
+    """
+    Upsert the given dates, and any date the store doesn't have under STATS_VERSION
+    yet, from the dataset into the metrics store. Returns the rows written.
+    """
+    dataset_dir = dataset_dir or Config.DATASET_DIR
+    with MetricsStore(store_file) as store:
+        written = [name[len("date="):] for name in os.listdir(dataset_dir)
+                   if name.startswith("date=") and not name.endswith(".tmp")]
+        todo = set(dates) | (set(written) - set(store.dates(Config.STATS_VERSION)))
+        if not todo:
+            return 0
+        return store.upsert(load_dataset(dataset_dir, sorted(todo)), version=Config.STATS_VERSION)
+
+
+def run(chm_by_date: Dict[str, str], shapefile: str, dataset_dir: str = None, workers: int = None,
+        force: bool = False) -> List[str]:
+    """
+    Bring the dataset up to date: only dates whose CHM, polygons or STATS_VERSION
+    changed since they were written (or that are missing) are computed, in parallel.
+    Each date is recorded in the dataset's manifest as soon as it is written.
+    Returns the dates computed - a date that failed is left for the next run.
+    """
+    dataset_dir = dataset_dir or Config.DATASET_DIR
+    workers = workers or Config.WORKERS
+    os.makedirs(dataset_dir, exist_ok=True)
+    manifest = BuildManifest(dataset_dir, hash_contents=False)
+    config = {"STATS_VERSION": Config.STATS_VERSION}
+
+    todo = {}
+    for date, chm_file in chm_by_date.items():
+        if chm_resolution(chm_file) is None:
+            print(f"  Warning: Could not extract resolution from {chm_file}")
+            continue
+        unit = {"date": date, "chm": chm_file}
+        fingerprints = manifest.fingerprints([chm_file, *shapefile_parts(shapefile)])
+        key = manifest.cache_key(unit, fingerprints, config)
+        if not force and manifest.is_up_to_date(partition_dir(dataset_dir, date), key):
+            print(f"  {date} is up to date")
+            continue
+        todo[date] = (unit, fingerprints, key)
+
+    if not todo:
+        return []
+    shapes = load_rehab_shapes(shapefile)
+    start_time = time.time()
+    computed = []
+    # spawned, not forked - a notebook kernel (metrics_time) has threads running
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(workers, len(todo)), mp_context=context) as executor:
+        futures = {
+            executor.submit(run_unit, date, unit["chm"], shapes, dataset_dir, Config.MEMORY_MB): date
+            for date, (unit, _, _) in todo.items()
+        }
+        for future in as_completed(futures):
+            date = futures[future]
+            try:
+                n = future.result()
+            except Exception as e:
+                # the other dates carry on - this one is retried on the next run
+                print(f"  Error processing {date}: {e}")
+                continue
+            unit, fingerprints, key = todo[date]
+            manifest.record(partition_dir(dataset_dir, date), key, unit, fingerprints, config)
+            computed.append(date)
+            print(f"  {date}: {n} polygons written ({time.time() - start_time:.1f}s)")
+    return sorted(computed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compute the zonal CHM stats for every survey date into a partitioned Parquet dataset.')
+    parser.add_argument('--date', action='append', help='Survey date folder to process (default all)')
+    parser.add_argument('--processed', default=PROCESSED_DIR, help='Folder with one subfolder of rasters per date')
+    parser.add_argument('--shapes', default=REHAB_SHAPEFILE, help='Rehab polygon shapefile')
+    parser.add_argument('--output', default=Config.DATASET_DIR, help='Dataset folder')
+    parser.add_argument('--workers', type=int, default=Config.WORKERS, help='Worker processes')
+    parser.add_argument('--force', action='store_true', help='Recompute dates that are already up to date')
+
+    args = parser.parse_args()
+    chm_by_date = find_chm_by_date(args.processed)
+    if args.date:
+        chm_by_date = {date: chm_by_date[date] for date in args.date}
+    computed = run(chm_by_date, args.shapes, args.output, args.workers, args.force)
+    if Config.STORE_FILE:
+        n = sync_store(Config.STORE_FILE, args.output, computed)
+        print(f"{n} rows upserted into {Config.STORE_FILE}")
+    if Config.COMBINED_FILE:
+        load_dataset(args.output).write_parquet(Config.COMBINED_FILE)
+        print(f"Combined stats written to {Config.COMBINED_FILE}")